@@ -0,0 +1,257 @@
+import math
+from PySide6 import QtCore, QtGui, QtWidgets
+from annotations import Keypoint, BoundingBox, Polygon, Mask
+
+
+class KeypointItem(QtWidgets.QGraphicsItem):
+    def __init__(self, annotation: Keypoint, image_width, image_height, pen: QtGui.QPen):
+        super().__init__()
+        self._annotation = annotation
+        self._image_width, self._image_height = image_width, image_height
+        self._pen = pen
+        self.sync()
+
+    def set_pen(self, pen: QtGui.QPen):
+        # Pens are shared per class, the same one handed in again means nothing changed
+        if pen is self._pen:
+            return
+        self.prepareGeometryChange()
+        self._pen = pen
+        self.update()
+
+    def sync(self):
+        # Moving a keypoint only changes the item position, nothing has to be repainted from scratch
+        self.setPos(int(self._annotation.x * self._image_width), int(self._annotation.y * self._image_height))
+
+    def boundingRect(self):
+        half = self._pen.widthF() / 2 + 1
+        return QtCore.QRectF(-half, -half, 2 * half, 2 * half)
+
+    def paint(self, painter, option, widget=None):
+        painter.setPen(self._pen)
+        painter.drawPoint(QtCore.QPointF(0, 0))
+
+
+class BoundingBoxItem(QtWidgets.QGraphicsItem):
+    _corner_pen = QtGui.QPen(QtCore.Qt.green, 10)
+
+    def __init__(self, annotation: BoundingBox, image_width, image_height, pen: QtGui.QPen):
+        super().__init__()
+        self._annotation = annotation
+        self._image_width, self._image_height = image_width, image_height
+        self._pen = pen
+        self._top_left = QtCore.QPointF()
+        self._bottom_right = QtCore.QPointF()
+        self.sync()
+
+    def set_pen(self, pen: QtGui.QPen):
+        if pen is self._pen:
+            return
+        self._pen = pen
+        self.update()
+
+    def sync(self):
+        self.prepareGeometryChange()
+        self._top_left = QtCore.QPointF(int(self._annotation.top_left_x * self._image_width),
+                                        int(self._annotation.top_left_y * self._image_height))
+        self._bottom_right = QtCore.QPointF(int(self._annotation.bottom_right_x * self._image_width),
+                                            int(self._annotation.bottom_right_y * self._image_height))
+        self.update()
+
+    def boundingRect(self):
+        margin = self._corner_pen.widthF() / 2 + 1
+        return QtCore.QRectF(self._top_left, self._bottom_right).normalized().adjusted(-margin, -margin,
+                                                                                      margin, margin)
+
+    def paint(self, painter, option, widget=None):
+        painter.setPen(self._pen)
+        painter.drawRect(QtCore.QRectF(self._top_left, self._bottom_right).normalized())
+
+        # Add special points on the corners of bounding box
+        painter.setPen(self._corner_pen)
+        painter.drawPoint(self._top_left)  # top-left corner
+        painter.drawPoint(QtCore.QPointF(self._bottom_right.x(), self._top_left.y()))  # top-right corner
+        painter.drawPoint(self._bottom_right)  # bottom-right corner
+        painter.drawPoint(QtCore.QPointF(self._top_left.x(), self._bottom_right.y()))  # bottom-left corner
+
+
+class PolygonItem(QtWidgets.QGraphicsItem):
+    _vertex_pen = QtGui.QPen(QtCore.Qt.green, 8)
+
+    def __init__(self, annotation: Polygon, image_width, image_height, pen: QtGui.QPen, brush: QtGui.QBrush):
+        super().__init__()
+        self._annotation = annotation
+        self._image_width, self._image_height = image_width, image_height
+        self._pen = pen
+        self._brush = brush
+        self._polygon = QtGui.QPolygonF()
+        self.sync()
+
+    def set_pen(self, pen: QtGui.QPen):
+        if pen is self._pen:
+            return
+        self._pen = pen
+        self.update()
+
+    def set_brush(self, brush: QtGui.QBrush):
+        if brush is self._brush:
+            return
+        self._brush = brush
+        self.update()
+
+    def sync(self):
+        self.prepareGeometryChange()
+        self._polygon = QtGui.QPolygonF([QtCore.QPointF(x * self._image_width, y * self._image_height)
+                                         for x, y in self._annotation.points])
+        self.update()
+
+    def boundingRect(self):
+        margin = self._vertex_pen.widthF() / 2 + 1
+        return self._polygon.boundingRect().adjusted(-margin, -margin, margin, margin)
+
+    def paint(self, painter, option, widget=None):
+        painter.setPen(self._pen)
+        painter.setBrush(self._brush)
+        painter.drawPolygon(self._polygon)
+        painter.setPen(self._vertex_pen)
+        painter.drawPoints(self._polygon)
+
+
+class MaskItem(QtWidgets.QGraphicsItem):
+    # Drawn from a cached image at display resolution that only covers the set pixels. While the mask is painted,
+    # only the part of the cache under the brush is resampled from the full resolution pixels
+    _growth_margin = 64
+
+    def __init__(self, annotation: Mask, image_width, image_height, pen: QtGui.QPen, brush: QtGui.QBrush):
+        super().__init__()
+        self._annotation = annotation
+        self._image_width, self._image_height = image_width, image_height
+        self._pen = pen
+        self._color = self._premultiplied(brush.color())
+        self._brush = brush
+        # Full resolution pixels, only kept while the mask is being painted
+        self.bitmap = None
+        # Counts the cache was rendered from, an undo or a hand edit replaces them
+        self._counts = None
+        self._rect = None
+        self._pixels = None
+        self._image = None
+        self.sync()
+
+    @staticmethod
+    def _premultiplied(color: QtGui.QColor):
+        alpha = color.alpha()
+        return ((alpha << 24) | (color.red() * alpha // 255 << 16) | (color.green() * alpha // 255 << 8)
+                | color.blue() * alpha // 255)
+
+    def set_pen(self, pen: QtGui.QPen):
+        # Masks have no outline, the pen is only kept for a uniform interface
+        self._pen = pen
+
+    def set_brush(self, brush: QtGui.QBrush):
+        if brush is self._brush:
+            return
+        self._brush = brush
+        color = self._premultiplied(brush.color())
+        if self._pixels is not None and color != self._color:
+            self._pixels[self._pixels != 0] = color
+            self.update()
+        self._color = color
+
+    def sync(self):
+        if self.bitmap is not None or self._annotation.counts is self._counts:
+            return
+        from masks import decode_mask
+        self._counts = self._annotation.counts
+        self._render_all(decode_mask(self._annotation))
+
+    def begin_painting(self, bitmap=None):
+        from masks import decode_mask
+        self.bitmap = decode_mask(self._annotation) if bitmap is None else bitmap
+
+    def end_painting(self):
+        # The annotation already holds the encoded bitmap, the cache was kept up to date while painting
+        self.bitmap = None
+        self._counts = self._annotation.counts
+
+    def _display_rect(self, left, top, right, bottom, bitmap):
+        scale_x, scale_y = bitmap.shape[1] / self._image_width, bitmap.shape[0] / self._image_height
+        return (max(math.floor(left / scale_x), 0), max(math.floor(top / scale_y), 0),
+                min(math.ceil(right / scale_x), self._image_width),
+                min(math.ceil(bottom / scale_y), self._image_height))
+
+    def _resample(self, bitmap, left, top, right, bottom):
+        import numpy as np
+        # Nearest pixel centers, the whole block in one indexing operation
+        scale_x, scale_y = bitmap.shape[1] / self._image_width, bitmap.shape[0] / self._image_height
+        columns = np.minimum(((np.arange(left, right) + 0.5) * scale_x).astype(np.intp), bitmap.shape[1] - 1)
+        rows = np.minimum(((np.arange(top, bottom) + 0.5) * scale_y).astype(np.intp), bitmap.shape[0] - 1)
+        return np.where(bitmap[np.ix_(rows, columns)], np.uint32(self._color), np.uint32(0))
+
+    def _set_cache(self, rect, pixels):
+        self.prepareGeometryChange()
+        self._rect, self._pixels = rect, pixels
+        if pixels is None:
+            self._image = None
+        else:
+            height, width = pixels.shape
+            # The image draws straight from the array, in-place updates of the array need no new image
+            self._image = QtGui.QImage(pixels.data, width, height, 4 * width,
+                                       QtGui.QImage.Format_ARGB32_Premultiplied)
+        self.update()
+
+    def _render_all(self, bitmap):
+        from masks import mask_bounds
+        bounds = mask_bounds(bitmap)
+        if bounds is None:
+            self._set_cache(None, None)
+            return
+        rect = self._display_rect(*bounds, bitmap)
+        self._set_cache(rect, self._resample(bitmap, *rect))
+
+    def painted(self, left, top, right, bottom):
+        # (left, top, right, bottom) of self.bitmap changed
+        changed = self._display_rect(left, top, right, bottom, self.bitmap)
+        if changed[0] >= changed[2] or changed[1] >= changed[3]:
+            return
+        if self._rect is not None and self._rect[0] <= changed[0] and self._rect[1] <= changed[1] and \
+                changed[2] <= self._rect[2] and changed[3] <= self._rect[3]:
+            column, row = changed[0] - self._rect[0], changed[1] - self._rect[1]
+            block = self._resample(self.bitmap, *changed)
+            self._pixels[row:row + block.shape[0], column:column + block.shape[1]] = block
+            self.update(QtCore.QRectF(changed[0], changed[1], changed[2] - changed[0], changed[3] - changed[1]))
+            return
+        # The brush left the cached area, it grows with a margin so the next strokes fit again
+        rect = changed if self._rect is None else (min(self._rect[0], changed[0]), min(self._rect[1], changed[1]),
+                                                   max(self._rect[2], changed[2]), max(self._rect[3], changed[3]))
+        margin = self._growth_margin
+        rect = (max(rect[0] - margin, 0), max(rect[1] - margin, 0),
+                min(rect[2] + margin, self._image_width), min(rect[3] + margin, self._image_height))
+        self._set_cache(rect, self._resample(self.bitmap, *rect))
+
+    def covers(self, x, y):
+        # Whether the pixel at display position (x, y) is set, read from the cache instead of the full mask
+        if self._rect is None:
+            return False
+        left, top, right, bottom = self._rect
+        return left <= x < right and top <= y < bottom and bool(self._pixels[int(y) - top, int(x) - left])
+
+    def boundingRect(self):
+        if self._rect is None:
+            return QtCore.QRectF()
+        left, top, right, bottom = self._rect
+        return QtCore.QRectF(left, top, right - left, bottom - top)
+
+    def paint(self, painter, option, widget=None):
+        if self._image is not None:
+            painter.drawImage(QtCore.QPointF(self._rect[0], self._rect[1]), self._image)
+
+
+def create_annotation_item(annotation, image_width, image_height, pen: QtGui.QPen, brush: QtGui.QBrush = None):
+    if isinstance(annotation, BoundingBox):
+        return BoundingBoxItem(annotation, image_width, image_height, pen)
+    if isinstance(annotation, Polygon):
+        return PolygonItem(annotation, image_width, image_height, pen, brush)
+    if isinstance(annotation, Mask):
+        return MaskItem(annotation, image_width, image_height, pen, brush)
+    return KeypointItem(annotation, image_width, image_height, pen)
@@ -0,0 +1,133 @@
+"""Annotation storage backends and import/export between them.
+
+Usage: python annotation_store.py {import,export} DIRECTORY [--database PATH] [--recursive]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+from annotations import parse_annotation, write_annotations
+from dataset import scan_images, annotation_path, read_image_annotations
+from instrumentation import recorder
+
+DATABASE_NAME = "annotations.db"
+
+
+class TextFileStore:
+    # One .txt file next to every image
+    def __init__(self, directory):
+        self._directory = directory
+
+    def load(self, image_name):
+        return read_image_annotations(self._directory, image_name)
+
+    def save(self, image_name, annotations):
+        with recorder.stage("save"):
+            write_annotations(annotation_path(self._directory, image_name), annotations)
+
+    def close(self):
+        pass
+
+
+class SQLiteAnnotationStore:
+    # Every image's annotations in one database, one row per image keyed by its relative path
+    def __init__(self, path):
+        # Saving may happen off the GUI thread, the lock serializes access to the shared connection
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS annotations (image TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID"
+            )
+
+    def load(self, image_name):
+        with self._lock:
+            row = self._connection.execute("SELECT data FROM annotations WHERE image = ?", (image_name,)).fetchone()
+        if row is None:
+            return []
+        return [parse_annotation(line) for line in row[0].splitlines() if line.strip()]
+
+    def save(self, image_name, annotations):
+        self.save_many([(image_name, annotations)])
+
+    def save_many(self, items):
+        # One transaction for all images, much faster than committing each of them
+        rows = [(image_name, "\n".join(annotation.to_text() for annotation in annotations))
+                for image_name, annotations in items]
+        with recorder.stage("save"), self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO annotations (image, data) VALUES (?, ?)", rows)
+
+    def image_names(self):
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT image FROM annotations ORDER BY image")]
+
+    def texts(self):
+        # Image name -> stored annotation lines, unparsed
+        with self._lock:
+            return dict(self._connection.execute("SELECT image, data FROM annotations"))
+
+    def contains(self, image_name):
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM annotations WHERE image = ?", (image_name,)).fetchone()
+        return row is not None
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def open_store(directory):
+    # A project database in the directory takes precedence over the .txt files
+    database_path = os.path.join(directory, DATABASE_NAME)
+    if os.path.exists(database_path):
+        return SQLiteAnnotationStore(database_path)
+    return TextFileStore(directory)
+
+
+def import_directory(store: SQLiteAnnotationStore, directory, recursive=False, batch_size=1000):
+    imported = 0
+    batch = []
+    for image_name in scan_images(directory, recursive):
+        if not os.path.exists(annotation_path(directory, image_name)):
+            continue
+        batch.append((image_name, read_image_annotations(directory, image_name)))
+        if len(batch) >= batch_size:
+            store.save_many(batch)
+            imported += len(batch)
+            batch = []
+    store.save_many(batch)
+    return imported + len(batch)
+
+
+def export_directory(store: SQLiteAnnotationStore, directory):
+    text_store = TextFileStore(directory)
+    image_names = store.image_names()
+    for image_name in image_names:
+        text_store.save(image_name, store.load(image_name))
+    return len(image_names)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move annotations between .txt files and a project database.")
+    parser.add_argument("command", choices=["import", "export"],
+                        help="import .txt files into the database or export the database to .txt files")
+    parser.add_argument("directory", help="directory with the images")
+    parser.add_argument("--database", default=None, help=f"database path, defaults to DIRECTORY/{DATABASE_NAME}")
+    parser.add_argument("--recursive", action="store_true", help="include images in subdirectories")
+    args = parser.parse_args(argv)
+
+    store = SQLiteAnnotationStore(args.database or os.path.join(args.directory, DATABASE_NAME))
+    try:
+        if args.command == "import":
+            count = import_directory(store, args.directory, args.recursive)
+        else:
+            count = export_directory(store, args.directory)
+    finally:
+        store.close()
+    print(f"{args.command.capitalize()}ed annotations of {count} images")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
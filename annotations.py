@@ -0,0 +1,137 @@
+import os
+
+
+class Keypoint:
+    __slots__ = ("class_idx", "x", "y")
+
+    def __init__(self, class_idx: int, x: float, y: float):
+        self.class_idx = class_idx
+        self.x = x
+        self.y = y
+
+    def coordinates(self):
+        return self.x, self.y
+
+    def set_coordinates(self, coordinates):
+        self.x, self.y = coordinates
+
+    def to_text(self):
+        return f"{self.class_idx}, {self.x:.6f}, {self.y:.6f}"
+
+
+class BoundingBox:
+    __slots__ = ("class_idx", "top_left_x", "top_left_y", "bottom_right_x", "bottom_right_y")
+
+    def __init__(self, class_idx: int, top_left_x: float, top_left_y: float,
+                 bottom_right_x: float, bottom_right_y: float):
+        self.class_idx = class_idx
+        self.top_left_x = top_left_x
+        self.top_left_y = top_left_y
+        self.bottom_right_x = bottom_right_x
+        self.bottom_right_y = bottom_right_y
+
+    def coordinates(self):
+        return self.top_left_x, self.top_left_y, self.bottom_right_x, self.bottom_right_y
+
+    def set_coordinates(self, coordinates):
+        self.top_left_x, self.top_left_y, self.bottom_right_x, self.bottom_right_y = coordinates
+
+    def corners(self):
+        # Corners in the order they are hit-tested
+        return (
+            ("top_left", self.top_left_x, self.top_left_y),
+            ("bottom_right", self.bottom_right_x, self.bottom_right_y),
+            ("top_right", self.bottom_right_x, self.top_left_y),
+            ("bottom_left", self.top_left_x, self.bottom_right_y),
+        )
+
+    def to_text(self):
+        return (f"{self.class_idx}, "
+                f"{self.top_left_x:.6f}, "
+                f"{self.top_left_y:.6f}, "
+                f"{self.bottom_right_x:.6f}, "
+                f"{self.bottom_right_y:.6f}")
+
+
+class Polygon:
+    __slots__ = ("class_idx", "points")
+
+    def __init__(self, class_idx: int, points):
+        self.class_idx = class_idx
+        # A tuple of (x, y) pairs, edits replace it so copies taken for undo never change along
+        self.points = tuple(points)
+
+    def coordinates(self):
+        return tuple(value for point in self.points for value in point)
+
+    def set_coordinates(self, coordinates):
+        self.points = tuple(zip(coordinates[0::2], coordinates[1::2]))
+
+    def to_text(self):
+        return f"{self.class_idx}, " + ", ".join(f"{x:.6f}, {y:.6f}" for x, y in self.points)
+
+
+class Mask:
+    __slots__ = ("class_idx", "width", "height", "counts")
+
+    def __init__(self, class_idx: int, width: int, height: int, counts):
+        self.class_idx = class_idx
+        # Pixels of the full image at its native size, run-length encoded in column-major order starting with a run
+        # of unset pixels, the uncompressed RLE of COCO. Decoding and encoding are in masks.py
+        self.width = width
+        self.height = height
+        self.counts = tuple(counts)
+
+    def coordinates(self):
+        return self.counts
+
+    def set_coordinates(self, coordinates):
+        self.counts = tuple(coordinates)
+
+    def to_text(self):
+        return f"{self.class_idx}, mask, {self.width}, {self.height}, " + " ".join(map(str, self.counts))
+
+
+def parse_annotation(text: str):
+    # Raises ValueError for lines that are no keypoint, bounding box, polygon or mask
+    elements = text.strip().split(",")
+    class_idx = int(elements[0])
+    if len(elements) == 5 and elements[1].strip() == "mask":
+        counts = [int(count) for count in elements[4].split()]
+        if any(count < 0 for count in counts):
+            raise ValueError(f"Mask runs may not be negative: {text[:80]!r}")
+        if sum(counts) != int(elements[2]) * int(elements[3]):
+            raise ValueError(f"Mask runs do not add up to its size: {text[:80]!r}")
+        return Mask(class_idx, int(elements[2]), int(elements[3]), counts)
+    if len(elements) == 3:  # Keypoint
+        return Keypoint(class_idx, float(elements[1]), float(elements[2]))
+    elif len(elements) == 5:  # Bounding box
+        return BoundingBox(class_idx, float(elements[1]), float(elements[2]), float(elements[3]), float(elements[4]))
+    elif len(elements) >= 7 and len(elements) % 2 == 1:  # Polygon of three or more vertices
+        values = [float(element) for element in elements[1:]]
+        return Polygon(class_idx, zip(values[0::2], values[1::2]))
+    raise ValueError(f"Expected 3, 5 or an odd number of at least 7 comma-separated fields, "
+                     f"got {len(elements)}: {text!r}")
+
+
+def read_annotations(path: str):
+    annotations = []
+    with open(path, "r") as file:
+        for line in file:
+            if line.strip():
+                annotations.append(parse_annotation(line))
+    return annotations
+
+
+def write_annotations(path: str, annotations):
+    # Write next to the target and rename, so a crash never leaves a half-written file behind
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "w") as file:
+            for annotation in annotations:
+                file.write(annotation.to_text() + "\n")
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
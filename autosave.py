@@ -0,0 +1,70 @@
+import threading
+from PySide6 import QtCore
+
+
+class Autosaver(QtCore.QObject):
+    # Emitted from the writer thread, Qt delivers it on the GUI thread
+    failed = QtCore.Signal(str)
+
+    def __init__(self, delay_ms=1000, parent=None):
+        super().__init__(parent)
+        # Restarted on every edit, so a burst of edits ends in a single write
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay_ms)
+        self._timer.timeout.connect(self.commit_now)
+        self._snapshot = None
+        # Latest annotations per (store, image name), older states that were not written yet are replaced
+        self._pending = {}
+        self._writing = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="autosave", daemon=True)
+        self._thread.start()
+
+    def schedule(self, snapshot):
+        # snapshot() returns (store, image name, annotations) and is only called once the edits settle
+        self._snapshot = snapshot
+        self._timer.start()
+
+    def commit_now(self):
+        self._timer.stop()
+        if self._snapshot is None:
+            return
+        store, image_name, annotations = self._snapshot()
+        self._snapshot = None
+        with self._condition:
+            self._pending[(store, image_name)] = annotations
+            self._condition.notify()
+
+    def flush(self):
+        # Block until everything handed over so far is on disk
+        self.commit_now()
+        with self._condition:
+            self._condition.wait_for(lambda: not self._pending and not self._writing)
+
+    def close(self):
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+                key = next(iter(self._pending))
+                annotations = self._pending.pop(key)
+                self._writing = True
+            store, image_name = key
+            try:
+                store.save(image_name, annotations)
+            except Exception as error:
+                self.failed.emit(f"Autosave of {image_name} failed: {error}")
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
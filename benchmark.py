@@ -0,0 +1,210 @@
+"""Time the annotator hot paths on synthetic data and write the results as JSON.
+
+Usage: python benchmark.py [--image-size 4000x3000] [--keypoints 2000] [--boxes 500] [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Must be set before Qt is imported, the benchmark never opens a window
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import PIL
+import PIL.Image
+import PySide6
+from PySide6 import QtCore, QtGui, QtWidgets
+from PySide6.QtCore import Qt
+from annotations import Keypoint, BoundingBox, write_annotations
+from main import ImageAnnotator
+
+
+def create_dataset(directory, image_count, image_size, keypoint_count, box_count, class_count, seed=0):
+    rng = random.Random(seed)
+    with open(os.path.join(directory, "classes.txt"), "w") as file:
+        file.writelines(f"class_{i}\n" for i in range(class_count))
+    # Noise is the worst case for JPEG decoding
+    image = PIL.Image.merge("RGB", [PIL.Image.effect_noise(image_size, 64) for _ in range(3)])
+    for i in range(image_count):
+        name = f"image_{i:05d}"
+        image.save(os.path.join(directory, name + ".jpg"), quality=90)
+        annotations = [Keypoint(rng.randrange(class_count), rng.random(), rng.random()) for _ in range(keypoint_count)]
+        for _ in range(box_count):
+            left, top = rng.uniform(0, 0.8), rng.uniform(0, 0.8)
+            annotations.append(BoundingBox(rng.randrange(class_count), left, top,
+                                           left + rng.uniform(0.01, 0.2), top + rng.uniform(0.01, 0.2)))
+        write_annotations(os.path.join(directory, name + ".txt"), annotations)
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    return {
+        "runs": len(durations),
+        "mean_ms": statistics.fmean(durations),
+        "median_ms": statistics.median(durations),
+        "min_ms": durations[0],
+        "max_ms": durations[-1],
+        "p95_ms": durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+    }
+
+
+def measure(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def wait_for(app, condition, timeout=60.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Timed out waiting for the annotator")
+        app.processEvents(QtCore.QEventLoop.AllEvents, 10)
+
+
+def mouse_event(window, kind, scene_x, scene_y, button=Qt.LeftButton, buttons=Qt.LeftButton):
+    position = QtCore.QPointF(window._graphics_view.mapFromScene(QtCore.QPointF(scene_x, scene_y)))
+    return QtGui.QMouseEvent(kind, position, position, button, buttons, Qt.NoModifier)
+
+
+def measure_startup(repeat):
+    # A fresh interpreter every time, from launch until the empty window has been shown and painted
+    code = ("import sys; from PySide6 import QtWidgets; import main; "
+            "app = QtWidgets.QApplication(sys.argv); window = main.ImageAnnotator(); window.show(); "
+            "app.processEvents()")
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return measure(lambda: subprocess.run([sys.executable, "-c", code], cwd=directory, check=True,
+                                          stderr=subprocess.DEVNULL), repeat)
+
+
+def isolate_user_state(directory):
+    # The annotator keeps settings and thumbnails like in a real session, they go here instead of the user's own.
+    # Set before the first window reads them, the startup processes inherit the environment
+    os.environ["XDG_CACHE_HOME"] = os.path.join(directory, "cache")
+    os.environ["XDG_CONFIG_HOME"] = os.path.join(directory, "config")
+    for settings_format in (QtCore.QSettings.NativeFormat, QtCore.QSettings.IniFormat):
+        QtCore.QSettings.setPath(settings_format, QtCore.QSettings.UserScope, os.environ["XDG_CONFIG_HOME"])
+
+
+def run(args):
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    with tempfile.TemporaryDirectory() as user_directory, tempfile.TemporaryDirectory() as directory:
+        isolate_user_state(user_directory)
+        results = {"startup": summarize(measure_startup(args.repeat))}
+        create_dataset(directory, args.images, args.image_size, args.keypoints, args.boxes, args.classes)
+        window = ImageAnnotator()
+        window.show()
+        window.resize(1600, 1000)
+        # Saving goes through the autosave writer, which never opens a file dialog
+        window._autosaveAction.setChecked(True)
+
+        def open_directory():
+            window.open_directory(directory)
+            wait_for(app, lambda: window._current_image_index is not None)
+            wait_for(app, lambda: window._scanner is None or window._scanner.isFinished())
+
+        results["open_directory"] = summarize(measure(open_directory, args.repeat))
+
+        def load_image_cold():
+            window._prefetcher.clear()
+            window._clear_annotations()
+            window.load_image()
+
+        results["load_image_cold"] = summarize(measure(load_image_cold, args.repeat))
+
+        def redraw():
+            window.update_image()
+            window._graphics_view.viewport().repaint()
+
+        results["full_redraw"] = summarize(measure(redraw, args.repeat))
+
+        width, height = window._m_pixmap.width(), window._m_pixmap.height()
+        keypoint = next(annotation for annotation in window._annotations if isinstance(annotation, Keypoint))
+        press_x, press_y = int(keypoint.x * width), int(keypoint.y * height)
+
+        def hit_test():
+            window._mode = "keypoints"
+            window.mouse_press(mouse_event(window, QtCore.QEvent.MouseButtonPress, press_x, press_y))
+            window._dragged_keypoint_index = None
+
+        results["hit_test"] = summarize(measure(hit_test, args.repeat * 10))
+
+        # One drag with many move events, each followed by whatever frame update or repaint is due by then
+        window.mouse_press(mouse_event(window, QtCore.QEvent.MouseButtonPress, press_x, press_y))
+        drag_durations = []
+        for step in range(args.drag_events):
+            x, y = press_x + (step % 40) - 20, press_y + (step % 30) - 15
+            start = time.perf_counter()
+            window.mouse_move(mouse_event(window, QtCore.QEvent.MouseMove, x, y, Qt.NoButton))
+            app.processEvents()
+            drag_durations.append((time.perf_counter() - start) * 1000)
+        window.mouse_release(mouse_event(window, QtCore.QEvent.MouseButtonRelease, press_x, press_y,
+                                         buttons=Qt.NoButton))
+        results["drag_event"] = summarize(drag_durations)
+
+        results["save"] = summarize(measure(window.save, args.repeat))
+        window.close()
+    return results
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "pyside6": PySide6.__version__,
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "parameters": {
+            "images": args.images,
+            "image_size": list(args.image_size),
+            "keypoints": args.keypoints,
+            "boxes": args.boxes,
+            "classes": args.classes,
+            "repeat": args.repeat,
+            "drag_events": args.drag_events,
+        },
+    }
+
+
+def image_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark load, redraw, hit-test, drag and save.")
+    parser.add_argument("--images", type=int, default=5, help="number of synthetic images")
+    parser.add_argument("--image-size", type=image_size, default=(4000, 3000), help="WIDTHxHEIGHT of every image")
+    parser.add_argument("--keypoints", type=int, default=2000, help="keypoints per image")
+    parser.add_argument("--boxes", type=int, default=500, help="bounding boxes per image")
+    parser.add_argument("--classes", type=int, default=10, help="number of classes")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions of every measurement")
+    parser.add_argument("--drag-events", type=int, default=500, help="mouse move events in the drag measurement")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file for the results")
+    args = parser.parse_args(argv)
+
+    report = {"metadata": metadata(args), "results": run(args)}
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    for name, stats in report["results"].items():
+        print(f"{name:<16} median {stats['median_ms']:9.3f} ms   p95 {stats['p95_ms']:9.3f} ms")
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import json
+import math
+import os
+from PySide6 import QtCore, QtGui
+
+CLASS_COLORS_NAME = "class_colors.json"
+# Consecutive classes are a golden angle apart in hue and alternate in lightness, so any number of them stays
+# distinguishable without a fixed palette running out
+_GOLDEN_ANGLE = 137.50776405
+_LIGHTNESS = (0.72, 0.58, 0.84)
+_CHROMA = 0.17
+_FILL_ALPHA = 70
+
+
+def _to_srgb(value):
+    if value <= 0.0031308:
+        return 12.92 * value
+    return 1.055 * value ** (1 / 2.4) - 0.055
+
+
+def _oklch_to_rgb(lightness, chroma, hue):
+    a, b = chroma * math.cos(hue), chroma * math.sin(hue)
+    l = (lightness + 0.3963377774 * a + 0.2158037573 * b) ** 3
+    m = (lightness - 0.1055613458 * a - 0.0638541728 * b) ** 3
+    s = (lightness - 0.0894841775 * a - 1.2914855480 * b) ** 3
+    return (_to_srgb(4.0767416621 * l - 3.3077115913 * m + 0.2309699292 * s),
+            _to_srgb(-1.2684380046 * l + 2.6097574011 * m - 0.3413193965 * s),
+            _to_srgb(-0.0041960863 * l - 0.7034186147 * m + 1.7076147010 * s))
+
+
+def palette_color(class_idx):
+    # Spaced in OKLCH, where equal steps look equally different, unlike hue steps in HSV
+    hue = math.radians(class_idx * _GOLDEN_ANGLE)
+    lightness = _LIGHTNESS[class_idx % len(_LIGHTNESS)]
+    chroma = _CHROMA
+    rgb = _oklch_to_rgb(lightness, chroma, hue)
+    # Colors outside the sRGB gamut lose saturation rather than being clipped into a different hue
+    while chroma > 0 and not all(0 <= channel <= 1 for channel in rgb):
+        chroma -= 0.01
+        rgb = _oklch_to_rgb(lightness, max(chroma, 0), hue)
+    return QtGui.QColor.fromRgbF(*(min(max(channel, 0.0), 1.0) for channel in rgb))
+
+
+class ClassStyles:
+    # One pen and brush per class, built once and handed out to every annotation item of that class
+    def __init__(self, point_size=5):
+        self._point_size = point_size
+        self._class_names = []
+        self._path = None
+        # Class name -> "#rrggbb", kept by name so reordering classes.txt does not mix them up
+        self._overrides = {}
+        self._colors = {}
+        self._box_pens = {}
+        self._keypoint_pens = {}
+        self._brushes = {}
+
+    def load(self, directory, class_names):
+        self._class_names = [name.strip() for name in class_names]
+        self._path = os.path.join(directory, CLASS_COLORS_NAME)
+        try:
+            with open(self._path, "r") as file:
+                self._overrides = dict(json.load(file))
+        except (OSError, ValueError, TypeError):
+            self._overrides = {}
+        self._clear()
+
+    def _clear(self):
+        self._colors.clear()
+        self._box_pens.clear()
+        self._keypoint_pens.clear()
+        self._brushes.clear()
+
+    def _class_name(self, class_idx):
+        return self._class_names[class_idx] if 0 <= class_idx < len(self._class_names) else None
+
+    def color(self, class_idx):
+        color = self._colors.get(class_idx)
+        if color is None:
+            override = self._overrides.get(self._class_name(class_idx))
+            color = QtGui.QColor(override) if override else QtGui.QColor()
+            if not color.isValid():
+                color = palette_color(class_idx)
+            self._colors[class_idx] = color
+        return color
+
+    def set_color(self, class_idx, color: QtGui.QColor):
+        # Raises OSError when the directory is not writable, the color still applies for this session
+        self._overrides[self._class_name(class_idx)] = color.name()
+        for cache in (self._colors, self._box_pens, self._keypoint_pens, self._brushes):
+            cache.pop(class_idx, None)
+        with open(self._path, "w") as file:
+            json.dump(self._overrides, file, indent=2)
+
+    def set_point_size(self, point_size):
+        if point_size != self._point_size:
+            self._point_size = point_size
+            self._keypoint_pens.clear()
+
+    def box_pen(self, class_idx):
+        pen = self._box_pens.get(class_idx)
+        if pen is None:
+            pen = self._box_pens[class_idx] = QtGui.QPen(self.color(class_idx), 2, QtCore.Qt.SolidLine)
+        return pen
+
+    def keypoint_pen(self, class_idx):
+        pen = self._keypoint_pens.get(class_idx)
+        if pen is None:
+            pen = self._keypoint_pens[class_idx] = QtGui.QPen(self.color(class_idx), self._point_size)
+        return pen
+
+    def brush(self, class_idx):
+        # Translucent fill for areas, the image stays visible underneath
+        brush = self._brushes.get(class_idx)
+        if brush is None:
+            color = QtGui.QColor(self.color(class_idx))
+            color.setAlpha(_FILL_ALPHA)
+            brush = self._brushes[class_idx] = QtGui.QBrush(color)
+        return brush
@@ -0,0 +1,184 @@
+"""Convert an annotated directory to YOLO, COCO or CSV without starting the GUI.
+
+Usage: python convert.py DIRECTORY {yolo,coco,csv} OUTPUT [--workers N] [--recursive]
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import PIL.Image
+from annotations import Keypoint, BoundingBox, Polygon, Mask, parse_annotation
+from masks import decode_mask, mask_area, mask_bounds
+from dataset import scan_images, read_class_names, annotation_path
+
+
+def _read_image(args):
+    directory, image_name = args
+    # Opening only reads the header, the pixels are never decoded
+    try:
+        with PIL.Image.open(os.path.join(directory, image_name)) as image:
+            width, height = image.size
+    except OSError as error:
+        return image_name, None, None, None, f"cannot open image: {error}"
+    annotations = []
+    path = annotation_path(directory, image_name)
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            for line_number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    annotations.append(parse_annotation(line))
+                except ValueError as error:
+                    # The image is left out rather than converted with part of its annotations
+                    return image_name, width, height, None, f"line {line_number}: {error}"
+    return image_name, width, height, annotations, None
+
+
+def read_dataset(directory, recursive=False, workers=None):
+    # Returns (image name, width, height, annotations) for every image, parsed in parallel, and
+    # (image name, error) for every image that could not be opened or whose annotation file could not be parsed
+    image_names = sorted(scan_images(directory, recursive))
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(image_names) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_read_image, [(directory, name) for name in image_names], chunksize=chunksize))
+    records = [(image_name, width, height, annotations)
+               for image_name, width, height, annotations, error in results if error is None]
+    failed = [(image_name, error) for image_name, _, _, _, error in results if error is not None]
+    return records, failed
+
+
+def _box_bounds(box: BoundingBox):
+    # Boxes can be stored with any two opposite corners
+    return (min(box.top_left_x, box.bottom_right_x), min(box.top_left_y, box.bottom_right_y),
+            max(box.top_left_x, box.bottom_right_x), max(box.top_left_y, box.bottom_right_y))
+
+
+def _polygon_bounds(polygon: Polygon):
+    xs, ys = [x for x, _ in polygon.points], [y for _, y in polygon.points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _polygon_area(polygon: Polygon, width, height):
+    # Shoelace formula in pixels
+    points = [(x * width, y * height) for x, y in polygon.points]
+    return abs(sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]))) / 2
+
+
+def _mask_bounds(mask: Mask):
+    # Normalized like every other coordinate, (0, 0, 0, 0) for an empty mask
+    bounds = mask_bounds(decode_mask(mask))
+    if bounds is None:
+        return 0.0, 0.0, 0.0, 0.0
+    left, top, right, bottom = bounds
+    return left / mask.width, top / mask.height, right / mask.width, bottom / mask.height
+
+
+def export_yolo(records, class_names, output):
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, "classes.txt"), "w") as file:
+        file.writelines(name + "\n" for name in class_names)
+    skipped = 0
+    for image_name, _, _, annotations in records:
+        label_path = os.path.join(output, os.path.splitext(image_name)[0] + ".txt")
+        os.makedirs(os.path.dirname(label_path), exist_ok=True)
+        with open(label_path, "w") as file:
+            for annotation in annotations:
+                if not isinstance(annotation, BoundingBox):
+                    # The YOLO detection format has no standalone points or outlines
+                    skipped += 1
+                    continue
+                left, top, right, bottom = _box_bounds(annotation)
+                file.write(f"{annotation.class_idx} {(left + right) / 2:.6f} {(top + bottom) / 2:.6f} "
+                           f"{right - left:.6f} {bottom - top:.6f}\n")
+    if skipped:
+        print(f"Skipped {skipped} keypoints, polygons and masks, YOLO labels only hold bounding boxes",
+              file=sys.stderr)
+
+
+def export_coco(records, class_names, output):
+    images, coco_annotations = [], []
+    for image_id, (image_name, width, height, annotations) in enumerate(records, start=1):
+        images.append({"id": image_id, "file_name": image_name, "width": width, "height": height})
+        for annotation in annotations:
+            coco_annotation = {"id": len(coco_annotations) + 1, "image_id": image_id,
+                               "category_id": annotation.class_idx, "iscrowd": 0}
+            if isinstance(annotation, BoundingBox):
+                left, top, right, bottom = _box_bounds(annotation)
+                box_width, box_height = (right - left) * width, (bottom - top) * height
+                coco_annotation["bbox"] = [left * width, top * height, box_width, box_height]
+                coco_annotation["area"] = box_width * box_height
+            elif isinstance(annotation, Keypoint):
+                coco_annotation["keypoints"] = [annotation.x * width, annotation.y * height, 2]
+                coco_annotation["num_keypoints"] = 1
+            elif isinstance(annotation, Polygon):
+                left, top, right, bottom = _polygon_bounds(annotation)
+                coco_annotation["segmentation"] = [[value * size for x, y in annotation.points
+                                                    for value, size in ((x, width), (y, height))]]
+                coco_annotation["bbox"] = [left * width, top * height, (right - left) * width, (bottom - top) * height]
+                coco_annotation["area"] = _polygon_area(annotation, width, height)
+            elif isinstance(annotation, Mask):
+                # Masks are stored as the uncompressed RLE of COCO already
+                left, top, right, bottom = _mask_bounds(annotation)
+                coco_annotation["segmentation"] = {"size": [annotation.height, annotation.width],
+                                                   "counts": list(annotation.counts)}
+                coco_annotation["bbox"] = [left * width, top * height, (right - left) * width, (bottom - top) * height]
+                # Pixels of the mask, counted at the size of the image should the two differ
+                scale = width * height / (annotation.width * annotation.height)
+                coco_annotation["area"] = mask_area(annotation) * scale
+            coco_annotations.append(coco_annotation)
+    categories = [{"id": class_idx, "name": name} for class_idx, name in enumerate(class_names)]
+    with open(output, "w") as file:
+        json.dump({"images": images, "annotations": coco_annotations, "categories": categories}, file)
+
+
+def export_csv(records, class_names, output):
+    # One row per annotation, keypoints leave the second corner empty, polygons and masks give their bounds
+    with open(output, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["image", "width", "height", "type", "class_idx", "class_name", "x1", "y1", "x2", "y2"])
+        for image_name, width, height, annotations in records:
+            for annotation in annotations:
+                class_name = class_names[annotation.class_idx] if annotation.class_idx < len(class_names) else ""
+                if isinstance(annotation, BoundingBox):
+                    writer.writerow([image_name, width, height, "bounding_box", annotation.class_idx, class_name,
+                                     *_box_bounds(annotation)])
+                elif isinstance(annotation, Keypoint):
+                    writer.writerow([image_name, width, height, "keypoint", annotation.class_idx, class_name,
+                                     annotation.x, annotation.y, "", ""])
+                elif isinstance(annotation, Polygon):
+                    writer.writerow([image_name, width, height, "polygon", annotation.class_idx, class_name,
+                                     *_polygon_bounds(annotation)])
+                elif isinstance(annotation, Mask):
+                    writer.writerow([image_name, width, height, "mask", annotation.class_idx, class_name,
+                                     *_mask_bounds(annotation)])
+
+
+EXPORTERS = {"yolo": export_yolo, "coco": export_coco, "csv": export_csv}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert an annotated directory to another annotation format.")
+    parser.add_argument("directory", help="directory with the images, their .txt files and classes.txt")
+    parser.add_argument("format", choices=sorted(EXPORTERS), help="output format")
+    parser.add_argument("output", help="output directory for yolo, output file for coco and csv")
+    parser.add_argument("--workers", type=int, default=None, help="number of parsing processes")
+    parser.add_argument("--recursive", action="store_true", help="include images in subdirectories")
+    args = parser.parse_args(argv)
+
+    class_names = read_class_names(args.directory)
+    records, failed = read_dataset(args.directory, args.recursive, args.workers)
+    for image_name, error in failed:
+        print(f"{image_name}: {error}", file=sys.stderr)
+    EXPORTERS[args.format](records, class_names, args.output)
+    print(f"Converted {len(records)} images to {args.format}: {args.output}")
+    if failed:
+        print(f"Skipped {len(failed)} unreadable images or images with malformed annotation files", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+import hashlib
+import os
+from annotations import read_annotations
+
+IMAGE_EXTENSIONS = (".jpg", ".png", ".gif", ".jpeg")
+
+
+def scan_images(directory, recursive=False, is_cancelled=lambda: False, extensions=IMAGE_EXTENSIONS):
+    # Yield image paths (or other files with the given extensions) relative to directory as soon as they are found
+    pending = [""]
+    while pending:
+        relative_dir = pending.pop()
+        try:
+            entries = os.scandir(os.path.join(directory, relative_dir))
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if is_cancelled():
+                    return
+                if entry.name.endswith(extensions):
+                    if entry.is_file():
+                        yield os.path.join(relative_dir, entry.name)
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    pending.append(os.path.join(relative_dir, entry.name))
+
+
+def read_class_names(directory):
+    with open(os.path.join(directory, "classes.txt"), "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def annotation_path(directory, image_name):
+    return os.path.join(directory, os.path.splitext(image_name)[0] + ".txt")
+
+
+def read_image_annotations(directory, image_name):
+    # Annotations of one image, an image without a .txt file has none
+    path = annotation_path(directory, image_name)
+    if not os.path.exists(path):
+        return []
+    return read_annotations(path)
+
+
+def cache_directory():
+    # Per user, shared by all datasets and kept between runs
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "simple-image-annotator")
+
+
+def _image_index_path(directory, recursive):
+    key = hashlib.blake2b(f"{os.path.abspath(directory)}\0{recursive}".encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_directory(), "indexes", key + ".txt")
+
+
+def _image_signatures(directory, image_names):
+    # Size and modification time of every image, annotation and database files next to them do not take part
+    signatures = []
+    for name in image_names:
+        stat = os.stat(os.path.join(directory, name))
+        signatures.append((stat.st_size, stat.st_mtime_ns))
+    return signatures
+
+
+def write_image_index(directory, recursive, image_names):
+    path = _image_index_path(directory, recursive)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = path + ".tmp"
+    signatures = _image_signatures(directory, image_names)
+    with open(temporary_path, "w") as file:
+        file.writelines(f"{size}\t{mtime}\t{name}\n" for name, (size, mtime) in zip(image_names, signatures))
+    os.replace(temporary_path, path)
+
+
+def _read_image_index_entries(directory, recursive):
+    entries = []
+    with open(_image_index_path(directory, recursive), "r") as file:
+        for line in file:
+            size, mtime, name = line.rstrip("\n").split("\t", 2)
+            entries.append((name, int(size), int(mtime)))
+    return entries
+
+
+def read_image_index(directory, recursive):
+    # The names of the last complete scan in their scan order, or None without an index. They are not checked against
+    # the directory, that takes a listing and a stat of every image, see image_index_is_current
+    try:
+        return [name for name, _, _ in _read_image_index_entries(directory, recursive)]
+    except (OSError, ValueError):
+        return None
+
+
+def image_index_is_current(directory, recursive, image_names):
+    # True while the index holds exactly the scanned image_names and none of those images changed since
+    try:
+        entries = _read_image_index_entries(directory, recursive)
+        if sorted(name for name, _, _ in entries) != sorted(image_names):
+            return False
+        signatures = _image_signatures(directory, [name for name, _, _ in entries])
+    except (OSError, ValueError):
+        return False
+    return signatures == [(size, mtime) for _, size, mtime in entries]
@@ -0,0 +1,152 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PySide6 import QtGui
+from instrumentation import recorder
+
+
+class PixelBufferImage(QtGui.QImage):
+    # QImage never copies pixel data it is constructed from, so the data lives exactly as long as the image
+    def __init__(self, data, width, height, bytes_per_line, image_format):
+        super().__init__(data, width, height, bytes_per_line, image_format)
+        self._data = data
+
+
+def to_qimage(image):
+    # Packed straight into the 32-bit formats Qt paints and uploads without another conversion, only modes
+    # without such a format are converted first
+    if image.mode not in ("RGB", "RGBA"):
+        has_alpha = "A" in image.mode or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+    width, height = image.size
+    if image.mode == "RGB":
+        # Pillow fills the padding byte itself, no RGBA copy of the whole image is made first
+        data = image.tobytes("raw", "BGRX")
+        image_format = QtGui.QImage.Format_RGB32
+    else:
+        # Premultiplied while packing, Qt would otherwise convert it on the GUI thread at upload
+        data = image.tobytes("raw", "BGRa")
+        image_format = QtGui.QImage.Format_ARGB32_Premultiplied
+    return PixelBufferImage(data, width, height, 4 * width, image_format)
+
+
+def decode_image(image_path, target_height, target_width, high_quality=False):
+    # Safe to run off the GUI thread, QImage (unlike QPixmap) is not tied to the display.
+    # PIL is imported on the first decode rather than at startup
+    from image_scaling import Resizer, FAST_RESAMPLE, HIGH_QUALITY_RESAMPLE, open_image
+    resample = HIGH_QUALITY_RESAMPLE if high_quality else FAST_RESAMPLE
+    with recorder.stage("decode"):
+        image = open_image(image_path)
+        resizer = Resizer(target_height, target_width, resample=resample)
+        image = resizer.resize(image)
+    with recorder.stage("to_qimage"):
+        return to_qimage(image)
+
+
+class ImageCache:
+    # Least recently used cache of decoded images, bounded by their size in bytes
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        with self._lock:
+            old_image = self._images.pop(key, None)
+            if old_image is not None:
+                self._bytes -= old_image.sizeInBytes()
+            self._images[key] = image
+            self._bytes += image.sizeInBytes()
+            # Always keep the newest image, even if it alone exceeds the budget
+            while self._bytes > self._max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._bytes -= evicted.sizeInBytes()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._images
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+
+class ImagePrefetcher:
+    def __init__(self, cache: ImageCache, target_height, target_width, high_quality=False, max_workers=2):
+        self._cache = cache
+        self._target_height = target_height
+        self._target_width = target_width
+        self._high_quality = high_quality
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._pending = {}
+        # Reentrant because a done callback runs immediately when the future already finished
+        self._lock = threading.RLock()
+
+    def _decode(self, image_path):
+        high_quality = self._high_quality
+        image = decode_image(image_path, self._target_height, self._target_width, high_quality)
+        with self._lock:
+            # A decode that was already running when the filter changed is not cached, clear() could not cancel it
+            if high_quality == self._high_quality:
+                self._cache.put(image_path, image)
+        return image
+
+    def _forget(self, image_path, future):
+        with self._lock:
+            if self._pending.get(image_path) is future:
+                del self._pending[image_path]
+
+    def get(self, image_path):
+        # Return the decoded image, waiting for an in-flight prefetch instead of decoding twice
+        image = self._cache.get(image_path)
+        if image is not None:
+            return image
+        with self._lock:
+            future = self._pending.get(image_path)
+        if future is not None and not future.cancelled():
+            try:
+                return future.result()
+            except Exception:
+                pass  # Decode again on this thread so the error reaches the caller
+        return self._decode(image_path)
+
+    def prefetch(self, image_paths):
+        with self._lock:
+            # Drop queued work for images that are no longer near the current one
+            for image_path, future in list(self._pending.items()):
+                if image_path not in image_paths and future.cancel():
+                    # The done callback already ran and may have removed it
+                    self._pending.pop(image_path, None)
+            for image_path in image_paths:
+                if image_path in self._pending or image_path in self._cache:
+                    continue
+                future = self._executor.submit(self._decode, image_path)
+                self._pending[image_path] = future
+                future.add_done_callback(lambda done, path=image_path: self._forget(path, done))
+
+    def set_high_quality(self, high_quality):
+        # Images decoded with the previous filter are dropped so they get decoded again
+        with self._lock:
+            self._high_quality = high_quality
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # Cancelling runs _forget right away, which removes entries from _pending
+            for future in list(self._pending.values()):
+                future.cancel()
+            self._pending.clear()
+        self._cache.clear()
+
+    def shutdown(self):
+        self.clear()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,206 @@
+import functools
+import os
+import threading
+import time
+from PySide6 import QtCore, QtGui
+from PySide6.QtCore import Qt
+from dataset import scan_images, write_image_index, image_index_is_current
+from thumbnails import THUMBNAIL_SIZE, thumbnail_directory, thumbnail_path, generate_thumbnail
+
+
+class DirectoryScanner(QtCore.QThread):
+    batch_found = QtCore.Signal(list)
+    # Every image name, sent when a list restored from the index no longer matches the directory
+    index_outdated = QtCore.Signal(list)
+
+    def __init__(self, directory, recursive=False, from_index=False, batch_size=500, batch_interval=0.1,
+                 parent=None):
+        super().__init__(parent)
+        self.directory = directory
+        self.recursive = recursive
+        # The list was restored from the index, the scan only checks it instead of sending batches
+        self._from_index = from_index
+        self._batch_size = batch_size
+        # Seconds after which a partial batch is sent anyway, so slow file systems still show progress
+        self._batch_interval = batch_interval
+
+    def run(self):
+        names = []
+        batch = []
+        # The first batch is small so the first image shows up right away
+        batch_size = 1
+        last_emit = time.monotonic()
+        for name in scan_images(self.directory, self.recursive, self.isInterruptionRequested):
+            names.append(name)
+            if self._from_index:
+                continue
+            batch.append(name)
+            if len(batch) >= batch_size or time.monotonic() - last_emit >= self._batch_interval:
+                self.batch_found.emit(batch)
+                batch = []
+                batch_size = self._batch_size
+                last_emit = time.monotonic()
+        if self.isInterruptionRequested():
+            return
+        if batch:
+            self.batch_found.emit(batch)
+        if self._from_index:
+            if image_index_is_current(self.directory, self.recursive, names):
+                return
+            self.index_outdated.emit(names)
+        try:
+            write_image_index(self.directory, self.recursive, names)
+        except OSError:
+            pass  # The index only shortens the next start
+
+
+class ThumbnailLoader(QtCore.QObject):
+    # Emitted from a callback thread of the process pool, Qt delivers it on the GUI thread
+    thumbnail_ready = QtCore.Signal(str)
+
+    def __init__(self, cache_directory=None, max_workers=None, parent=None):
+        super().__init__(parent)
+        self._cache_directory = cache_directory or thumbnail_directory()
+        self._max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self._executor = None
+        self._directory = None
+        # Cache file of every image asked for so far, so repaints never touch the file system
+        self._paths = {}
+        self._pending = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def set_directory(self, directory):
+        self.cancel_pending()
+        with self._lock:
+            self._directory = directory
+            self._paths.clear()
+            self._failed.clear()
+
+    def get(self, image_name):
+        # The thumbnail if it was already generated, otherwise None and a worker is asked to generate it
+        path = self._paths.get(image_name)
+        if path is None:
+            image_path = os.path.join(self._directory, image_name)
+            try:
+                path = self._paths[image_name] = thumbnail_path(image_path, self._cache_directory)
+            except OSError:
+                return None
+        pixmap = QtGui.QPixmapCache.find(path)
+        if pixmap is not None:
+            return pixmap
+        if os.path.exists(path):
+            pixmap = QtGui.QPixmap(path)
+            if not pixmap.isNull():
+                QtGui.QPixmapCache.insert(path, pixmap)
+                return pixmap
+        self._request(image_name, path)
+        return None
+
+    def _request(self, image_name, path):
+        with self._lock:
+            if image_name in self._pending or image_name in self._failed:
+                return
+            if self._executor is None:
+                # Started with the first missing thumbnail, not at startup
+                self._executor = self._create_executor()
+            from concurrent.futures.process import BrokenProcessPool
+            image_path = os.path.join(self._directory, image_name)
+            try:
+                future = self._executor.submit(generate_thumbnail, image_path, path)
+            except BrokenProcessPool:
+                # A worker died (out of memory, a crashing decoder) and the pool takes no more work, so it is replaced.
+                # The thumbnails it still had fail and keep their placeholder
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create_executor()
+                future = self._executor.submit(generate_thumbnail, image_path, path)
+            self._pending[image_name] = future
+        future.add_done_callback(functools.partial(self._generated, self._directory, image_name))
+
+    def _create_executor(self):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Spawned rather than forked, forking a process that runs Qt threads is not safe
+        return ProcessPoolExecutor(max_workers=self._max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _generated(self, directory, image_name, future):
+        with self._lock:
+            if directory != self._directory:
+                return
+            if self._pending.get(image_name) is future:
+                del self._pending[image_name]
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                # Unreadable images keep the placeholder instead of being retried on every repaint
+                self._failed.add(image_name)
+                return
+        self.thumbnail_ready.emit(image_name)
+
+    def prioritize(self, visible_names):
+        # Rows scrolled past before their thumbnail was started are dropped, they are requested again when shown
+        visible_names = set(visible_names)
+        with self._lock:
+            futures = [future for name, future in self._pending.items() if name not in visible_names]
+        # Cancelled outside the lock, a successful cancel runs _generated right away and that takes the lock too.
+        # _generated also drops the cancelled entries from _pending
+        for future in futures:
+            future.cancel()
+
+    def cancel_pending(self):
+        with self._lock:
+            futures = list(self._pending.values())
+            self._pending.clear()
+        for future in futures:
+            future.cancel()
+
+    def shutdown(self):
+        self.cancel_pending()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ImageListModel(QtCore.QAbstractListModel):
+    def __init__(self, thumbnails: ThumbnailLoader = None, parent=None):
+        super().__init__(parent)
+        self.filenames = []
+        self._rows = {}
+        self._thumbnails = thumbnails
+        if thumbnails is not None:
+            thumbnails.thumbnail_ready.connect(self._thumbnail_ready)
+        # Rows without a thumbnail yet keep the same size as the others
+        self._placeholder = QtGui.QPixmap(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+        self._placeholder.fill(Qt.lightGray)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.filenames)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return self.filenames[index.row()]
+        # Views only ask for the rows they show, so thumbnails are loaded lazily as the list scrolls
+        if role == Qt.DecorationRole and self._thumbnails is not None:
+            return self._thumbnails.get(self.filenames[index.row()]) or self._placeholder
+        return None
+
+    def _thumbnail_ready(self, image_name):
+        row = self._rows.get(image_name)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def append(self, names):
+        first = len(self.filenames)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(names) - 1)
+        self.filenames.extend(names)
+        self._rows.update((name, row) for row, name in enumerate(names, start=first))
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        # A new list, so a reference held by a previous directory is left untouched
+        self.filenames = []
+        self._rows = {}
+        self.endResetModel()
@@ -1,11 +1,26 @@
 from PIL import Image
-import PIL.ImageQt
+import PIL.Image
+
+FAST_RESAMPLE = Image.BILINEAR
+HIGH_QUALITY_RESAMPLE = Image.LANCZOS
+# Gigapixel scans are only ever decoded reduced or one tile at a time, PIL's decompression bomb check would refuse
+# anything above about 179 megapixels
+Image.MAX_IMAGE_PIXELS = None
+
+
+def open_image(path):
+    return Image.open(path)
 
 
 class Resizer:
-    def __init__(self, target_height, target_width):
+    def __init__(self, target_height, target_width, resample=Image.BICUBIC, reducing_gap=3.0, use_draft=True):
         self._target_height = target_height
         self._target_width = target_width
+        self._resample = resample
+        # Shrink by an integer factor first (cheap box reduce), then resample the rest with self._resample
+        self._reducing_gap = reducing_gap
+        # Let JPEG decode straight to a smaller size with DCT scaling instead of decoding every pixel
+        self._use_draft = use_draft
 
     def _resize_factor(self, image):
         height_ratio = image.size[1] / self._target_height
@@ -18,5 +33,8 @@ class Resizer:
 
     def resize(self, image: PIL.Image.Image):
         scaled_h, scaled_w = self.scaled_image_dims(image)
-        image = image.resize(size=(scaled_w, scaled_h))
+        if self._use_draft and image.format == "JPEG":
+            # Only takes effect before the image is loaded, the result is never smaller than the requested size
+            image.draft(image.mode, (scaled_w, scaled_h))
+        image = image.resize(size=(scaled_w, scaled_h), resample=self._resample, reducing_gap=self._reducing_gap)
         return image
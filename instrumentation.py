@@ -0,0 +1,91 @@
+import contextlib
+import cProfile
+import json
+import threading
+import time
+from collections import deque
+
+
+class _Stage:
+    __slots__ = ("_recorder", "_name", "_start")
+
+    def __init__(self, recorder, name):
+        self._recorder = recorder
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._recorder.record(self._name, self._start, time.perf_counter())
+        return False
+
+
+class Instrumentation:
+    # Opt-in stage timers, a disabled recorder costs one attribute check per stage
+    _disabled_stage = contextlib.nullcontext()
+
+    def __init__(self, window=1000, max_trace_events=100000):
+        self.enabled = False
+        self._window = window
+        self._durations = {}
+        self._trace_events = deque(maxlen=max_trace_events)
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._profile = None
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def stage(self, name):
+        if not self.enabled:
+            return self._disabled_stage
+        return _Stage(self, name)
+
+    def record(self, name, start, end):
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = deque(maxlen=self._window)
+            durations.append((end - start) * 1000)
+            self._trace_events.append((name, start, end, threading.get_ident()))
+
+    def percentiles(self, quantiles=(50, 95, 99)):
+        # {stage: {"p50": ms, ...}} over the last `window` samples of every stage
+        with self._lock:
+            snapshot = {name: sorted(durations) for name, durations in self._durations.items() if durations}
+        return {
+            name: {f"p{q}": durations[min(len(durations) - 1, len(durations) * q // 100)] for q in quantiles}
+            for name, durations in snapshot.items()
+        }
+
+    def dump_chrome_trace(self, path):
+        # Loadable in chrome://tracing and Perfetto
+        with self._lock:
+            events = list(self._trace_events)
+        trace_events = [
+            {"name": name, "ph": "X", "pid": 0, "tid": thread_id,
+             "ts": (start - self._origin) * 1e6, "dur": (end - start) * 1e6}
+            for name, start, end, thread_id in events
+        ]
+        with open(path, "w") as file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file)
+
+    def start_profiling(self):
+        # cProfile only sees the thread it was started on, normally the GUI thread
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop_profiling(self, path):
+        if self._profile is None:
+            return
+        self._profile.disable()
+        self._profile.dump_stats(path)
+        self._profile = None
+
+
+recorder = Instrumentation()
@@ -0,0 +1,32 @@
+from PySide6 import QtCore, QtWidgets
+from instrumentation import Instrumentation
+
+
+class LatencyOverlay(QtWidgets.QLabel):
+    # Stage percentiles drawn in the corner of the image view, refreshed on a timer instead of on every frame
+    def __init__(self, instrumentation: Instrumentation, parent=None, interval_ms=500):
+        super().__init__(parent)
+        self._instrumentation = instrumentation
+        self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents)
+        self.setStyleSheet("background-color: rgba(0, 0, 0, 160); color: white; "
+                           "font-family: monospace; padding: 4px;")
+        self.move(8, 8)
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(interval_ms)
+        self._timer.timeout.connect(self.refresh)
+        self.hide()
+
+    def set_active(self, active):
+        self.setVisible(active)
+        if active:
+            self.refresh()
+            self._timer.start()
+        else:
+            self._timer.stop()
+
+    def refresh(self):
+        lines = [f"{'stage':<12}{'p50':>9}{'p95':>9}{'p99':>9}  ms"]
+        for name, values in sorted(self._instrumentation.percentiles().items()):
+            lines.append(f"{name:<12}{values['p50']:>9.2f}{values['p95']:>9.2f}{values['p99']:>9.2f}")
+        self.setText("\n".join(lines))
+        self.adjustSize()
@@ -1,33 +1,87 @@
+import copy
 import os
 import sys
-import random
-import PIL
-import PIL.Image
-from PIL import ImageQt
 from PySide6 import QtGui, QtCore, QtWidgets
 from PySide6.QtCore import Qt
 from PySide6.QtGui import QAction
 from PySide6.QtWidgets import QFileDialog, QColorDialog, QSpinBox
-from image_scaling import Resizer
+from image_cache import ImageCache, ImagePrefetcher
+from image_list import DirectoryScanner, ImageListModel, ThumbnailLoader
+from annotation_store import SQLiteAnnotationStore, open_store
+from autosave import Autosaver
+from tiled_image import TileLoader, TileSource, TiledImageItem
+from instrumentation import recorder
+from dataset import read_image_index
+from annotations import Keypoint, BoundingBox, Polygon, Mask, parse_annotation, write_annotations
+from annotation_items import create_annotation_item
+from class_styles import ClassStyles
+from spatial_index import GridIndex
+from thumbnails import THUMBNAIL_SIZE
+from undo import (AddCommand, DeleteCommand, MoveCommand, ReclassCommand, ReplaceCommand,
+                  UndoStack)
 
 
 class ImageAnnotator(QtWidgets.QMainWindow):
     def __init__(self):
         super().__init__()
+        self._settings = QtCore.QSettings("PypayaTech", "Simple Image Annotator")
         self.initUI()
         self.setWindowTitle("Simple Image Annotator")
         self._target_height, self._target_width = 1920, 1080
+        # Decoded neighbours of the current image are kept ready for next/prev navigation
+        self._prefetch_count = 2
+        self._image_cache = ImageCache(max_bytes=512 * 1024 * 1024)
+        self._prefetcher = ImagePrefetcher(self._image_cache, self._target_height, self._target_width)
         self._is_saved = True
         self._mode = "keypoints"
-        self._class_colors = []
+        self._class_styles = ClassStyles(self._point_size_spinbox.value())
+        self._annotations = []
+        self._annotation_items = []
+        # Pixel positions of keypoints and box corners, keyed by (row, handle order, handle name)
+        self._spatial_index = GridIndex()
+        self._hit_threshold = 5
+        # Edits of the current image, cleared whenever another image is loaded
+        self._undo_stack = UndoStack()
         self._current_image_index = None
         self._image_filenames = None
+        self._scanner = None
+        # Image to switch to once the scan finds it, dropped as soon as the user picks another image
+        self._pending_image_name = None
+        self._pre_annotation = None
+        self._work_queue_mode = False
+        self._annotation_store = None
+        self._autosaver = Autosaver(parent=self)
+        self._autosaver.failed.connect(self.statusBar().showMessage)
+        # Opt-in diagnostics for the field: a Chrome trace and/or a cProfile dump written on exit
+        self._trace_path = os.environ.get("SIMPLE_ANNOTATOR_TRACE")
+        self._profile_path = os.environ.get("SIMPLE_ANNOTATOR_PROFILE")
+        if self._trace_path:
+            recorder.enable()
+        if self._profile_path:
+            recorder.start_profiling()
         self._dragged_keypoint_index = None
         self._bounding_box_start = None
         self._bounding_box_end = None
         self._dragged_box_index = None
         self._dragged_box_corner = None
         self._dragging_corner = False
+        self._drag_start_coordinates = None
+        # Scene positions of the polygon being drawn, and the polygon vertex being dragged
+        self._polygon_points = []
+        self._dragged_vertex_index = None
+        self._dragged_vertex = None
+        # The mask being painted, the last brush position in native pixels and what changed since the last frame
+        self._painted_mask_index = None
+        self._paint_value = True
+        self._last_paint_position = None
+        self._painted_rect = None
+        self._native_size = None
+        # Mouse moves only update the model, the scene follows at most once per frame (about 60 Hz)
+        self._moved_annotation_index = None
+        self._move_timer = QtCore.QTimer(self)
+        self._move_timer.setSingleShot(True)
+        self._move_timer.setInterval(16)
+        self._move_timer.timeout.connect(self._flush_mouse_move)
 
     def initUI(self):
         # Create a QGraphicsView to display the image
@@ -38,16 +92,37 @@ class ImageAnnotator(QtWidgets.QMainWindow):
         self._graphics_view.setScene(self._scene)
         self._m_pixmap = QtGui.QPixmap()
         self._image_item = QtWidgets.QGraphicsPixmapItem(self._m_pixmap)
+        self._image_item.setZValue(-2)
         self._scene.addItem(self._image_item)
 
+        # Full resolution tiles are drawn over the downscaled pixmap when zooming in
+        self._tile_loader = TileLoader(parent=self)
+        self._tile_loader.tile_ready.connect(self._tile_ready)
+        self._tiled_item = None
+        self._max_zoom = 10.0
+
+        # The bounding box being drawn is a single item that is reshaped while dragging
+        self._rubber_band_item = QtWidgets.QGraphicsRectItem()
+        self._rubber_band_item.setPen(QtGui.QPen(QtGui.QColor(QtCore.Qt.green), 1, QtCore.Qt.SolidLine))
+        self._rubber_band_item.setZValue(1)
+        self._rubber_band_item.hide()
+        self._scene.addItem(self._rubber_band_item)
+
+        # Likewise the vertices placed so far of the polygon being drawn
+        self._polygon_draft_item = QtWidgets.QGraphicsPathItem()
+        self._polygon_draft_item.setPen(QtGui.QPen(QtGui.QColor(QtCore.Qt.green), 1, QtCore.Qt.SolidLine))
+        self._polygon_draft_item.setZValue(1)
+        self._polygon_draft_item.hide()
+        self._scene.addItem(self._polygon_draft_item)
+
         # Create a QDockWidget to hold the keypoints list
         self._coordinates_dock = QtWidgets.QDockWidget("Points and boxes", self)
         self._coordinates_dock.setFixedWidth(250)
         self.addDockWidget(Qt.RightDockWidgetArea, self._coordinates_dock)
 
-        # Create a QListWidget to display the key points
+        # Create a QListWidget to display the key points, it is only a view over self._annotations
         self._coordinates_list = QtWidgets.QListWidget()
-        self._coordinates_list.itemChanged.connect(self.update_image)
+        self._coordinates_list.itemChanged.connect(self._annotation_item_edited)
         self._coordinates_dock.setWidget(self._coordinates_list)
 
         # Create a QDockWidget to hold the image list
@@ -55,8 +130,15 @@ class ImageAnnotator(QtWidgets.QMainWindow):
         self._image_list_dock.setFixedWidth(250)
         self.addDockWidget(Qt.RightDockWidgetArea, self._image_list_dock)
 
-        # Create a QListWidget to display the image names
-        self._image_list = QtWidgets.QListWidget()
+        # Create a QListView to display the image names and thumbnails, only the visible rows are ever laid out
+        self._thumbnail_loader = ThumbnailLoader(parent=self)
+        self._image_model = ImageListModel(self._thumbnail_loader, parent=self)
+        self._image_list = QtWidgets.QListView()
+        self._image_list.setUniformItemSizes(True)
+        self._image_list.setLayoutMode(QtWidgets.QListView.Batched)
+        self._image_list.setIconSize(QtCore.QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self._image_list.setModel(self._image_model)
+        self._image_list.verticalScrollBar().valueChanged.connect(self._image_list_scrolled)
         self._image_list_dock.setWidget(self._image_list)
 
         # Create the left toolbar
@@ -64,11 +146,11 @@ class ImageAnnotator(QtWidgets.QMainWindow):
 
         # Connect events to the appropriate functions for adding and moving key points
         self._graphics_view.mousePressEvent = self.mouse_press
-        self._graphics_view.mouseMoveEvent = self.mouse_move
+        self._graphics_view.mouseMoveEvent = self._timed("mouse_move", self.mouse_move)
+        self._graphics_view.paintEvent = self._timed("frame", self._graphics_view.paintEvent)
+        self._latency_overlay = None
         self._graphics_view.mouseReleaseEvent = self.mouse_release
-        self._image_list.itemClicked.connect(self.go_to_image)
-
-        self.show()
+        self._image_list.clicked.connect(self.go_to_image)
 
     def create_left_toolbar(self):
         self._left_toolbar = QtWidgets.QToolBar("Left Toolbar")
@@ -98,6 +180,23 @@ class ImageAnnotator(QtWidgets.QMainWindow):
         self._saveAction.triggered.connect(self.save)
         self._left_toolbar.addAction(self._saveAction)
 
+        # Create the "Undo" action
+        self._undoAction = QAction("Undo", self)
+        self._undoAction.setShortcut(QtGui.QKeySequence.Undo)
+        self._undoAction.triggered.connect(self.undo)
+        self._left_toolbar.addAction(self._undoAction)
+
+        # Create the "Redo" action
+        self._redoAction = QAction("Redo", self)
+        self._redoAction.setShortcut(QtGui.QKeySequence.Redo)
+        self._redoAction.triggered.connect(self.redo)
+        self._left_toolbar.addAction(self._redoAction)
+
+        # Create the "Autosave" action, edits are then written in the background instead of asking
+        self._autosaveAction = QAction("Autosave", self)
+        self._autosaveAction.setCheckable(True)
+        self._left_toolbar.addAction(self._autosaveAction)
+
         # Create the "Change color" action
         self._changeColorAction = QAction(QtGui.QIcon(os.path.join("resources", "icons", "color.png")),
                                           "Change point color", self)
@@ -109,50 +208,311 @@ class ImageAnnotator(QtWidgets.QMainWindow):
         self._point_size_spinbox = QSpinBox()
         self._point_size_spinbox.setRange(1, 100)
         self._point_size_spinbox.setValue(5)
+        self._point_size_spinbox.valueChanged.connect(self._point_size_changed)
         self._left_toolbar.addWidget(self._point_size_spinbox)
 
+        # Create the "Brush size" action, the diameter of the mask brush in screen pixels of the unzoomed image
+        self._brush_size_spinbox = QSpinBox()
+        self._brush_size_spinbox.setRange(1, 200)
+        self._brush_size_spinbox.setValue(20)
+        self._brush_size_spinbox.setToolTip("Brush size")
+        self._left_toolbar.addWidget(self._brush_size_spinbox)
+
         # Create the "Switch Mode" action
         self._switchModeAction = QAction(QtGui.QIcon(os.path.join("resources", "icons", "next.png")),
                                          "Switch Mode (Current: keypoints)", self)
         self._switchModeAction.triggered.connect(self.switch_mode)
         self._left_toolbar.addAction(self._switchModeAction)
 
+        # Create the "High quality" action, browsing uses a faster resampling filter by default
+        self._highQualityAction = QAction("High quality", self)
+        self._highQualityAction.setCheckable(True)
+        self._highQualityAction.toggled.connect(self.set_high_quality)
+        self._left_toolbar.addAction(self._highQualityAction)
+
+        # Create the "Include subdirectories" action, it applies to the next opened directory
+        self._recursiveScanAction = QAction("Include subdirectories", self)
+        self._recursiveScanAction.setCheckable(True)
+        self._left_toolbar.addAction(self._recursiveScanAction)
+
+        # Create the "Latency overlay" action, stage timers only run while it is on
+        self._latencyOverlayAction = QAction("Latency overlay", self)
+        self._latencyOverlayAction.setCheckable(True)
+        self._latencyOverlayAction.toggled.connect(self.set_latency_overlay)
+        self._left_toolbar.addAction(self._latencyOverlayAction)
+
+        # Create the "Pre-annotate" action, a model proposes annotations for every unannotated image
+        self._preAnnotateAction = QAction("Pre-annotate", self)
+        self._preAnnotateAction.triggered.connect(self.pre_annotate)
+        self._left_toolbar.addAction(self._preAnnotateAction)
+
+        # Create the "Join work queue" action, images are then handed out by a work queue server
+        self._joinWorkQueueAction = QAction("Join work queue", self)
+        self._joinWorkQueueAction.triggered.connect(self.join_work_queue)
+        self._left_toolbar.addAction(self._joinWorkQueueAction)
+
+        # Create the "Reopen last directory" action, the next start then continues at the last shown image
+        self._reopenLastAction = QAction("Reopen last directory", self)
+        self._reopenLastAction.setCheckable(True)
+        self._reopenLastAction.setChecked(self._settings.value("reopen_last_directory", False, type=bool))
+        self._reopenLastAction.toggled.connect(
+            lambda checked: self._settings.setValue("reopen_last_directory", checked))
+        self._left_toolbar.addAction(self._reopenLastAction)
+
+    def _timed(self, stage, handler):
+        def timed_handler(*args):
+            with recorder.stage(stage):
+                return handler(*args)
+        return timed_handler
+
+    def set_latency_overlay(self, enabled):
+        if enabled:
+            recorder.enable()
+        elif not self._trace_path:
+            recorder.disable()
+        if self._latency_overlay is None:
+            # Modules only some sessions need are imported when they are first used, not at startup
+            from latency_overlay import LatencyOverlay
+            self._latency_overlay = LatencyOverlay(recorder, self._graphics_view)
+        self._latency_overlay.set_active(enabled)
+
     def switch_mode(self):
-        self._mode = "keypoints" if self._mode == "bounding_boxes" else "bounding_boxes"
+        modes = ("keypoints", "bounding_boxes", "polygons", "masks")
+        self._mode = modes[(modes.index(self._mode) + 1) % len(modes)]
         self._switchModeAction.setText(f"Switch Mode (Current: {self._mode})")
+        # A polygon that was not closed is dropped
+        self._polygon_points = []
+        self._update_rubber_band()
+
+    def set_high_quality(self, enabled):
+        self._prefetcher.set_high_quality(enabled)
+        if self._current_image_index is not None:
+            # The image size does not change, so the annotations can stay where they are
+            self._load_pixmap()
 
     def open_dir(self):
         options = QFileDialog.Options()
         options |= QFileDialog.ReadOnly
         directory = QFileDialog.getExistingDirectory(self, "Select a directory", options=options)
         if directory:
-            self._coordinates_list.clear()
-            with open(os.path.join(directory, "classes.txt"), "r") as file:
-                self._class_names = file.readlines()
-            self._current_directory = directory
-            self._image_filenames = [
-                name for name in os.listdir(directory)
-                if any(name.endswith(ext) for ext in [".jpg", ".png", ".gif", ".jpeg"])
-            ]
+            self.open_directory(directory)
+
+    def open_directory(self, directory, use_index=False, image_name=None):
+        self._open_dataset(directory, open_store(directory))
+        recursive = self._recursiveScanAction.isChecked()
+        self._settings.setValue("last_directory", directory)
+        self._settings.setValue("last_recursive", recursive)
+        image_names = read_image_index(directory, recursive) if use_index else None
+        if image_names is None:
+            self._pending_image_name = image_name
+            self._start_scanning(directory)
+            return
+        # Shown right away, the scanner checks in the background whether the directory still holds these images
+        self._start_scanning(directory, from_index=True)
+        if not image_names:
+            return
+        self._image_model.append(image_names)
+        index = image_names.index(image_name) if image_name in image_names else 0
+        if not os.path.exists(os.path.join(directory, image_names[index])):
+            # Gone since the index was written, the scanner replaces the list and loads its first image
+            return
+        self._current_image_index = index
+        self._select_current_image()
+        self.load_image()
+
+    def reopen_last_directory(self):
+        # The image list comes from the index of the last complete scan and is replaced if the directory changed since
+        directory = self._settings.value("last_directory")
+        if not self._reopenLastAction.isChecked() or not directory or not os.path.isdir(directory):
+            return
+        self._recursiveScanAction.setChecked(self._settings.value("last_recursive", False, type=bool))
+        self.open_directory(directory, use_index=True, image_name=self._settings.value("last_image"))
+
+    def join_work_queue(self):
+        url, ok = QtWidgets.QInputDialog.getText(self, "Join work queue", "Work queue server",
+                                                 text="http://127.0.0.1:8765")
+        if not ok or not url:
+            return
+        from work_queue import WorkQueueStore
+        try:
+            store = WorkQueueStore(url)
+        except RuntimeError as error:
+            self.statusBar().showMessage(str(error))
+            return
+        # Instead of scanning the directory, images are added as they are leased
+        self._open_dataset(store.directory, store, work_queue=True)
+        self._lease_images()
+
+    def _open_dataset(self, directory, store, work_queue=False):
+        self._maybe_save()
+        self._clear_annotations()
+        with open(os.path.join(directory, "classes.txt"), "r") as file:
+            self._class_names = file.readlines()
+        self._current_directory = directory
+        self._stop_scanning()
+        self._stop_pre_annotation()
+        # Writes still queued for the previous store must reach it before it is closed
+        self._autosaver.flush()
+        if self._annotation_store is not None:
+            try:
+                self._annotation_store.close()
+            except RuntimeError as error:
+                self.statusBar().showMessage(str(error))
+        self._annotation_store = store
+        self._work_queue_mode = work_queue
+        self._prefetcher.clear()
+        self._thumbnail_loader.set_directory(directory)
+        self._current_image_index = None
+        self._pending_image_name = None
+        self._class_styles.load(directory, self._class_names)
+        self._image_model.clear()
+        self._image_filenames = self._image_model.filenames
+
+    def _start_scanning(self, directory, from_index=False):
+        self._stop_scanning()
+        # Image names arrive in batches from a background thread, the first image is loaded as soon as it is found
+        self._scanner = DirectoryScanner(directory, recursive=self._recursiveScanAction.isChecked(),
+                                         from_index=from_index, parent=self)
+        self._scanner.batch_found.connect(self._add_image_filenames)
+        self._scanner.index_outdated.connect(self._replace_image_filenames)
+        self._scanner.start()
+
+    def _stop_scanning(self):
+        if self._scanner is None:
+            return
+        self._scanner.requestInterruption()
+        self._scanner.wait()
+        self._scanner.deleteLater()
+        self._scanner = None
+
+    def pre_annotate(self):
+        # Images of a work queue are annotated through the queue only
+        if self._image_filenames is None or self._pre_annotation is not None or self._work_queue_mode:
+            return
+        model_spec, ok = QtWidgets.QInputDialog.getText(self, "Pre-annotate",
+                                                        "Model (.onnx file or module:function)")
+        if not ok or not model_spec:
+            return
+        from pre_annotation_thread import PreAnnotationThread
+        self._pre_annotation = PreAnnotationThread(self._current_directory, model_spec, list(self._image_filenames),
+                                                   self._annotation_store, parent=self)
+        self._pre_annotation.progress.connect(self._pre_annotation_progress)
+        self._pre_annotation.done.connect(self._pre_annotation_done)
+        self._pre_annotation.failed.connect(self.statusBar().showMessage)
+        self._pre_annotation.finished.connect(self._pre_annotation_finished)
+        self._pre_annotation.start()
+
+    def _stop_pre_annotation(self):
+        if self._pre_annotation is None:
+            return
+        self._pre_annotation.requestInterruption()
+        self._pre_annotation.wait()
+        self._pre_annotation.deleteLater()
+        self._pre_annotation = None
+
+    def _pre_annotation_finished(self):
+        # A run stopped for a previously opened directory was already cleaned up
+        if self.sender() is self._pre_annotation:
+            self._stop_pre_annotation()
+
+    def _pre_annotation_progress(self, done, total):
+        self.statusBar().showMessage(f"Pre-annotating: {done}/{total} images")
+
+    def _pre_annotation_done(self, written):
+        if self.sender() is not self._pre_annotation:
+            return
+        self.statusBar().showMessage(f"Pre-annotation wrote proposals for {written} images")
+        # Show the proposals right away if the current image was one of them and has not been touched
+        if self._current_image_index is not None and not self._annotations and self._is_saved:
+            self._clear_annotations()
+            self.load_image()
+
+    def _replace_image_filenames(self, names):
+        # The list restored from the index is outdated, the current image stays shown if it is still there
+        if self.sender() is not self._scanner:
+            return
+        current_name = None
+        if self._current_image_index is not None:
+            current_name = self._image_filenames[self._current_image_index]
+            if current_name not in names:
+                self._maybe_save()
+                self._clear_annotations()
+                self._current_image_index = None
+        self._image_model.clear()
+        self._image_filenames = self._image_model.filenames
+        if not names:
+            return
+        self._image_model.append(names)
+        if self._current_image_index is not None:
+            self._current_image_index = names.index(current_name)
+            self._select_current_image()
+            self._prefetch_neighbours()
+        else:
             self._current_image_index = 0
-            for i in range(len(self._class_names)):
-                color = "#" + "".join([random.choice("0123456789ABCDEF") for _ in range(6)])
-                self._class_colors.append(color)
-            self._image_list.clear()
-            for name in self._image_filenames:
-                self._image_list.addItem(name)
-            self._current_image_item = self._image_list.item(0)
-            self._current_image_item.setSelected(True)
+            self._select_current_image()
             self.load_image()
 
-    def go_to_image(self, item):
-        if not self._is_saved:
-            if self._ask_for_saving() == QtWidgets.QMessageBox.Yes:
-                self.save()
-            self._is_saved = True
-        self._current_image_index = self._image_list.row(item)
-        self._coordinates_list.clear()
-        self._current_image_item = item
+    def _add_image_filenames(self, names):
+        # Batches queued by a scanner of a previously opened directory are dropped
+        if self.sender() is not self._scanner:
+            return
+        self._image_model.append(names)
+        if self._pending_image_name in names:
+            index = self._image_filenames.index(self._pending_image_name)
+            self._pending_image_name = None
+            # The first image was shown meanwhile, it is only left while it has no unsaved edits
+            if self._current_image_index is None or self._is_saved:
+                self._clear_annotations()
+                self._current_image_index = index
+                self._select_current_image()
+                self.load_image()
+                return
+        if self._current_image_index is None:
+            self._current_image_index = 0
+            self._select_current_image()
+            self.load_image()
+        else:
+            # New neighbours of the current image may have just been found
+            self._prefetch_neighbours()
+
+    def _image_list_scrolled(self):
+        # Thumbnails still waiting for a worker are only generated if their row is still in view
+        first = self._image_list.indexAt(self._image_list.viewport().rect().topLeft()).row()
+        last = self._image_list.indexAt(self._image_list.viewport().rect().bottomLeft()).row()
+        if first < 0:
+            return
+        if last < 0:
+            last = len(self._image_filenames) - 1
+        self._thumbnail_loader.prioritize(self._image_filenames[first:last + 1])
+
+    def _lease_images(self):
+        try:
+            names = self._annotation_store.lease()
+        except RuntimeError as error:
+            self.statusBar().showMessage(str(error))
+            return
+        # An expired lease may hand the same image out again
+        known_names = set(self._image_filenames)
+        names = [name for name in names if name not in known_names]
+        if names:
+            self._image_model.append(names)
+        if not self._image_filenames:
+            self.statusBar().showMessage("The work queue has no open images")
+        elif self._current_image_index is None:
+            self._current_image_index = 0
+            self._select_current_image()
+            self.load_image()
+        else:
+            self._prefetch_neighbours()
+
+    def _select_current_image(self):
+        self._image_list.setCurrentIndex(self._image_model.index(self._current_image_index))
+
+    def go_to_image(self, index):
+        self._pending_image_name = None
+        self._maybe_save()
+        self._current_image_index = index.row()
+        self._clear_annotations()
         self.load_image()
 
     def next_image(self):
@@ -160,14 +520,11 @@ class ImageAnnotator(QtWidgets.QMainWindow):
             return
         if self._current_image_index == len(self._image_filenames) - 1:
             return
-        if not self._is_saved:
-            if self._ask_for_saving() == QtWidgets.QMessageBox.Yes:
-                self.save()
-            self._is_saved = True
-        self._coordinates_list.clear()
+        self._pending_image_name = None
+        self._maybe_save()
+        self._clear_annotations()
         self._current_image_index += 1
-        self._current_image_item = self._image_list.item(self._current_image_index)
-        self._current_image_item.setSelected(True)
+        self._select_current_image()
         self.load_image()
 
     def prev_image(self):
@@ -175,71 +532,91 @@ class ImageAnnotator(QtWidgets.QMainWindow):
             return
         if self._current_image_index == 0:
             return
-        if not self._is_saved:
-            if self._ask_for_saving() == QtWidgets.QMessageBox.Yes:
-                self.save()
-            self._is_saved = True
-        self._coordinates_list.clear()
+        self._pending_image_name = None
+        self._maybe_save()
+        self._clear_annotations()
         self._current_image_index -= 1
-        self._current_image_item = self._image_list.item(self._current_image_index)
-        self._current_image_item.setSelected(True)
+        self._select_current_image()
         self.load_image()
 
+    def _maybe_save(self):
+        # Called before the current image is left
+        if self._work_queue_mode and self._current_image_index is not None:
+            # Leaving an assigned image hands it in, also when there was nothing to annotate on it
+            self._autosaver.schedule(self._annotation_snapshot)
+            self._autosaver.commit_now()
+        elif self._autosaveAction.isChecked():
+            if not self._is_saved:
+                # Edits made before autosave was switched on were never scheduled
+                self._autosaver.schedule(self._annotation_snapshot)
+            self._autosaver.commit_now()
+        elif not self._is_saved:
+            if self._ask_for_saving() == QtWidgets.QMessageBox.Yes:
+                self.save()
+        self._is_saved = True
+
+    def _mark_dirty(self):
+        # Only real annotation edits end up here, redraws do not
+        self._is_saved = False
+        if self._autosaveAction.isChecked():
+            self._autosaver.schedule(self._annotation_snapshot)
+
+    def _annotation_snapshot(self):
+        # A copy, the background writer must not see later edits half applied. Once handed over, the edits count as saved
+        self._is_saved = True
+        return (self._annotation_store, self._image_filenames[self._current_image_index],
+                [copy.copy(annotation) for annotation in self._annotations])
+
     def save(self):
+        if self._autosaveAction.isChecked():
+            self._autosaver.schedule(self._annotation_snapshot)
+            self._autosaver.flush()
+            return
         current_image_name = self._image_filenames[self._current_image_index]
+        if self._work_queue_mode or isinstance(self._annotation_store, SQLiteAnnotationStore):
+            # The project database and the work queue have exactly one place for every image, there is nothing to ask
+            try:
+                self._annotation_store.save(current_image_name, self._annotations)
+            except RuntimeError as error:
+                # The work queue keeps what it could not hand in for the next submit
+                self.statusBar().showMessage(str(error))
+            self._is_saved = True
+            return
         default_file_name = os.path.splitext(current_image_name)[0] + ".txt"
         default_name = os.path.join(self._current_directory, default_file_name)
         filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save File", default_name, "Text Files (*.txt)")
         if filename:
-            with open(filename, "w") as file:
-                for i in range(self._coordinates_list.count()):
-                    item_text = self._coordinates_list.item(i).text().split(",")
-                    class_idx = item_text[0]
-                    if len(item_text) == 3:  # Keypoint
-                        normalized_x, normalized_y = item_text[1], item_text[2]
-                        file.write(f"{class_idx}, {normalized_x}, {normalized_y}\n")
-                    elif len(item_text) == 5:  # Bounding box
-                        normalized_top_left_x, normalized_top_left_y = item_text[1], item_text[2]
-                        normalized_bottom_right_x, normalized_bottom_right_y = item_text[3], item_text[4]
-                        file.write(
-                            f"{class_idx}, {normalized_top_left_x}, {normalized_top_left_y}, {normalized_bottom_right_x}, {normalized_bottom_right_y}\n")
-                self._is_saved = True
+            with recorder.stage("save"):
+                write_annotations(filename, self._annotations)
+            self._is_saved = True
 
     def _select_point_color(self):
         class_name, ok = QtWidgets.QInputDialog.getItem(self, "Select class dialog",
                                                         "List of classes", self._class_names, 0, False)
         if ok:
             class_idx = self._class_names.index(class_name)
-            color = QColorDialog.getColor(QtGui.QColor(self._class_colors[class_idx]), self, "Select point color")
+            color = QColorDialog.getColor(self._class_styles.color(class_idx), self, "Select point color")
             if color.isValid():
-                self._class_colors[class_idx] = color.name()
-                for i in range(self._coordinates_list.count()):
-                    item = self._coordinates_list.item(i)
-                    item_text = item.text().split(",")
-                    item_class_idx = int(item_text[0])
-                    if item_class_idx == class_idx:
-                        if len(item_text) == 3:  # Keypoint
-                            normalized_x, normalized_y = item_text[1], item_text[2]
-                            item.setText(f"{item_class_idx}, {normalized_x}, {normalized_y}")
-                        elif len(item_text) == 5:  # Bounding box
-                            normalized_top_left_x, normalized_top_left_y = item_text[1], item_text[2]
-                            normalized_bottom_right_x, normalized_bottom_right_y = item_text[3], item_text[4]
-                            item.setText(
-                                f"{item_class_idx}, "
-                                f"{normalized_top_left_x}, "
-                                f"{normalized_top_left_y}, "
-                                f"{normalized_bottom_right_x}, "
-                                f"{normalized_bottom_right_y}"
-                            )
-
-                self.update_image()
+                try:
+                    self._class_styles.set_color(class_idx, color)
+                except OSError as error:
+                    self.statusBar().showMessage(f"Class color could not be saved: {error}")
+                self._restyle_annotations()
 
     def mouse_press(self, event):
-        if event.button() != Qt.LeftButton:
+        if event.button() == Qt.RightButton and self._mode == "polygons":
+            # Right click drops the polygon being drawn
+            self._polygon_points = []
+            self._update_rubber_band()
+            return
+        # In mask mode the right button erases
+        erase = event.button() == Qt.RightButton and self._mode == "masks"
+        if event.button() != Qt.LeftButton and not erase:
             return
 
-        x = int(self._graphics_view.mapToScene(event.pos()).x())
-        y = int(self._graphics_view.mapToScene(event.pos()).y())
+        # Kept fractional, when zoomed into the full resolution tiles a scene unit spans several native pixels
+        scene_pos = self._graphics_view.mapToScene(event.pos())
+        x, y = scene_pos.x(), scene_pos.y()
         normalized_x, normalized_y = x / self._m_pixmap.width(), y / self._m_pixmap.height()
 
         # If click is outside the image, just return and ignore the event
@@ -248,95 +625,134 @@ class ImageAnnotator(QtWidgets.QMainWindow):
 
         if self._mode == "keypoints":
             # Check if the user clicked on an existing keypoint
-            for i in range(self._coordinates_list.count()):
-                item = self._coordinates_list.item(i)
-                if len(item.text().split(",")) != 3:  # Bounding box
-                    continue
-                class_idx, item_normalized_x, item_normalized_y = item.text().split(",")
-                item_x, item_y = int(float(item_normalized_x) * self._m_pixmap.width()), int(
-                    float(item_normalized_y) * self._m_pixmap.height())
-                if abs(item_x - x) < 5 and abs(item_y - y) < 5:  # adjust the threshold (5) as needed
-                    self._dragged_keypoint_index = i
-                    return
+            hits = [key for key in self._spatial_index.query(x, y, self._hit_threshold) if key[2] == "point"]
+            if hits:
+                self._dragged_keypoint_index = min(hits)[0]
+                self._drag_start_coordinates = self._annotations[self._dragged_keypoint_index].coordinates()
+                return
 
             class_name, ok = QtWidgets.QInputDialog.getItem(self, "Select class dialog",
                                                             "List of classes", self._class_names, 0, False)
             if not ok:
                 return
             class_idx = self._class_names.index(class_name)
-            item = QtWidgets.QListWidgetItem(f"{class_idx}, {normalized_x:.4f}, {normalized_y:.4f}")
-            item.setFlags(item.flags() | QtCore.Qt.ItemFlag.ItemIsEditable)
-            self._coordinates_list.addItem(item)
+            self._add_annotation(Keypoint(class_idx, normalized_x, normalized_y))
+            self._undo_stack.push(AddCommand(len(self._annotations) - 1, self._annotations[-1]))
+            self._mark_dirty()
             self.update_image()
             self.update()
 
         elif self._mode == "bounding_boxes":
             # Check if the user clicked on a corner of an existing bounding box
-            for i in range(self._coordinates_list.count()):
-                item = self._coordinates_list.item(i)
-                if len(item.text().split(",")) != 5:  # Keypoint
-                    continue
-                class_idx, normalized_top_left_x, normalized_top_left_y, \
-                    normalized_bottom_right_x, normalized_bottom_right_y = item.text().split(",")
-                top_left_x, top_left_y = int(float(normalized_top_left_x) * self._m_pixmap.width()), int(
-                    float(normalized_top_left_y) * self._m_pixmap.height())
-                bottom_right_x, bottom_right_y = int(float(normalized_bottom_right_x) * self._m_pixmap.width()), int(
-                    float(normalized_bottom_right_y) * self._m_pixmap.height())
-
-                top_right_x, top_right_y = bottom_right_x, top_left_y
-                bottom_left_x, bottom_left_y = top_left_x, bottom_right_y
-
-                corners = [
-                    ("top_left", top_left_x, top_left_y),
-                    ("bottom_right", bottom_right_x, bottom_right_y),
-                    ("top_right", top_right_x, top_right_y),
-                    ("bottom_left", bottom_left_x, bottom_left_y),
-                ]
-
-                for corner, corner_x, corner_y in corners:
-                    if abs(corner_x - x) < 5 and abs(corner_y - y) < 5:
-                        self._dragged_box_index = i
-                        self._dragged_box_corner = corner
-                        return
+            hits = [key for key in self._spatial_index.query(x, y, self._hit_threshold)
+                    if isinstance(self._annotations[key[0]], BoundingBox)]
+            if hits:
+                self._dragged_box_index, _, self._dragged_box_corner = min(hits)
+                self._drag_start_coordinates = self._annotations[self._dragged_box_index].coordinates()
+                return
 
             # Set the start position of the bounding box
-            self._bounding_box_start = self._graphics_view.mapToScene(event.pos()).toPoint()
+            self._bounding_box_start = scene_pos
+
+        elif self._mode == "polygons":
+            if not self._polygon_points:
+                # Check if the user clicked on a vertex or the middle of an edge of an existing polygon
+                hits = [key for key in self._spatial_index.query(x, y, self._hit_threshold)
+                        if key[2] in ("vertex", "midpoint")]
+                if hits:
+                    row, order, handle = min(hits, key=lambda key: (key[2] != "vertex", key))
+                    polygon = self._annotations[row]
+                    self._drag_start_coordinates = polygon.coordinates()
+                    if handle == "midpoint":
+                        # Dragging the middle of an edge adds a vertex there
+                        order += 1
+                        points = list(polygon.points)
+                        points.insert(order, (normalized_x, normalized_y))
+                        self._unindex_annotation(row)
+                        polygon.points = tuple(points)
+                        self._refresh_annotation_item(row)
+                    self._dragged_vertex_index, self._dragged_vertex = row, order
+                    return
+
+            # Clicking the first vertex again closes the polygon
+            if len(self._polygon_points) >= 3:
+                first = self._polygon_points[0]
+                if abs(first.x() - x) < self._hit_threshold and abs(first.y() - y) < self._hit_threshold:
+                    self._finish_polygon()
+                    return
+            self._polygon_points.append(scene_pos)
+            self._update_rubber_band()
+
+        elif self._mode == "masks":
+            self._press_mask(x, y, erase)
 
     def mouse_move(self, event):
-        x, y = int(self._graphics_view.mapToScene(event.pos()).x()), int(
-            self._graphics_view.mapToScene(event.pos()).y())
+        scene_pos = self._graphics_view.mapToScene(event.pos())
+        x, y = scene_pos.x(), scene_pos.y()
         normalized_x, normalized_y = x / self._m_pixmap.width(), y / self._m_pixmap.height()
 
         if self._mode == "keypoints":
-            if self._dragged_keypoint_index is not None:
-                item = self._coordinates_list.item(self._dragged_keypoint_index)
-                class_idx = item.text().split(",")[0]
-                item.setText(f"{class_idx}, {normalized_x:.4f}, {normalized_y:.4f}")
-                self.update_image()
+            if self._dragged_keypoint_index is None:
+                return
+            annotation = self._annotations[self._dragged_keypoint_index]
+            annotation.x, annotation.y = normalized_x, normalized_y
+            self._moved_annotation_index = self._dragged_keypoint_index
         elif self._mode == "bounding_boxes":
             if self._dragged_box_index is not None:
                 self._dragging_corner = True
-                item = self._coordinates_list.item(self._dragged_box_index)
-                class_idx, top_left_x, top_left_y, bottom_right_x, bottom_right_y = [elem.strip() for elem in item.text().split(",")]
+                annotation = self._annotations[self._dragged_box_index]
                 if self._dragged_box_corner == "top_left":
-                    item.setText(f"{class_idx}, {normalized_x:.4f}, {normalized_y:.4f}, {bottom_right_x}, {bottom_right_y}")
+                    annotation.top_left_x, annotation.top_left_y = normalized_x, normalized_y
                 elif self._dragged_box_corner == "bottom_right":
-                    item.setText(f"{class_idx}, {top_left_x}, {top_left_y}, {normalized_x:.4f}, {normalized_y:.4f}")
+                    annotation.bottom_right_x, annotation.bottom_right_y = normalized_x, normalized_y
                 elif self._dragged_box_corner == "top_right":
-                    item.setText(f"{class_idx}, {top_left_x}, {normalized_y:.4f}, {normalized_x:.4f}, {bottom_right_y}")
+                    annotation.bottom_right_x, annotation.top_left_y = normalized_x, normalized_y
                 elif self._dragged_box_corner == "bottom_left":
-                    item.setText(f"{class_idx}, {normalized_x:.4f}, {top_left_y}, {bottom_right_x}, {normalized_y:.4f}")
-                self.update_image()
+                    annotation.top_left_x, annotation.bottom_right_y = normalized_x, normalized_y
+                self._moved_annotation_index = self._dragged_box_index
+            elif event.buttons() & QtCore.Qt.LeftButton:
+                # Update the end position of the bounding box
+                self._bounding_box_end = scene_pos
             else:
-                if event.buttons() & QtCore.Qt.LeftButton:
-                    # Update the end position of the bounding box
-                    self._bounding_box_end = self._graphics_view.mapToScene(event.pos()).toPoint()
-                    # Redraw the image
-                    self.update_image()
+                return
+        elif self._mode == "polygons":
+            if self._dragged_vertex_index is None:
+                return
+            polygon = self._annotations[self._dragged_vertex_index]
+            points = list(polygon.points)
+            points[self._dragged_vertex] = (normalized_x, normalized_y)
+            polygon.points = tuple(points)
+            self._moved_annotation_index = self._dragged_vertex_index
+        elif self._mode == "masks":
+            if self._painted_mask_index is None:
+                return
+            self._paint_to(self._native_position(x, y))
+        if not self._move_timer.isActive():
+            self._move_timer.start()
+
+    def _flush_mouse_move(self):
+        # Bring the list row, graphics item, index and rubber band up to date with the latest mouse position
+        self._move_timer.stop()
+        if self._moved_annotation_index is not None:
+            self._refresh_annotation_item(self._moved_annotation_index)
+            self._moved_annotation_index = None
+            self._mark_dirty()
+        if self._painted_rect is not None:
+            # Only the part of the mask under the brush is rendered again, the mask is encoded when the stroke ends
+            self._annotation_items[self._painted_mask_index].painted(*self._painted_rect)
+            self._painted_rect = None
+        self._update_rubber_band()
 
     def mouse_release(self, event):
+        if self._painted_mask_index is not None:
+            # A stroke ends with whichever button painted or erased it
+            self._flush_mouse_move()
+            self._finish_painting()
+            return
         if event.button() != Qt.LeftButton:
             return
+        # The final position is always committed, even if its frame has not come yet
+        self._flush_mouse_move()
 
         if self._mode == "keypoints":
             if self._dragged_keypoint_index is None:
@@ -344,26 +760,23 @@ class ImageAnnotator(QtWidgets.QMainWindow):
             x, y = int(self._graphics_view.mapToScene(event.pos()).x()), int(self._graphics_view.mapToScene(event.pos()).y())
             # Check if the keypoint is outside the image
             if x < 0 or x >= self._m_pixmap.width() or y < 0 or y >= self._m_pixmap.height():
-                # Remove the keypoint from the QListWidget
-                item_to_delete = self._coordinates_list.takeItem(self._dragged_keypoint_index)
-                del item_to_delete
-                self.update_image()
+                self._remove_dragged_annotation(self._dragged_keypoint_index)
+            else:
+                self._push_move(self._dragged_keypoint_index)
             self._dragged_keypoint_index = None
 
         elif self._mode == "bounding_boxes":
             if self._dragged_box_index is not None:  # Dragging behaviour
-                item = self._coordinates_list.item(self._dragged_box_index)
-                class_idx, normalized_top_left_x, normalized_top_left_y, normalized_bottom_right_x, normalized_bottom_right_y = item.text().split(",")
-                top_left_x, top_left_y = int(float(normalized_top_left_x) * self._m_pixmap.width()), int(
-                    float(normalized_top_left_y) * self._m_pixmap.height())
-                bottom_right_x, bottom_right_y = int(float(normalized_bottom_right_x) * self._m_pixmap.width()), int(
-                    float(normalized_bottom_right_y) * self._m_pixmap.height())
+                annotation = self._annotations[self._dragged_box_index]
+                top_left_x, top_left_y = int(annotation.top_left_x * self._m_pixmap.width()), int(
+                    annotation.top_left_y * self._m_pixmap.height())
+                bottom_right_x, bottom_right_y = int(annotation.bottom_right_x * self._m_pixmap.width()), int(
+                    annotation.bottom_right_y * self._m_pixmap.height())
                 if top_left_x >= bottom_right_x or top_left_y >= bottom_right_y or \
                         top_left_x < 0 or top_left_y < 0 or bottom_right_x >= self._m_pixmap.width() or bottom_right_y >= self._m_pixmap.height():
-                    # Remove the bounding box from the QListWidget
-                    item_to_delete = self._coordinates_list.takeItem(self._dragged_box_index)
-                    del item_to_delete
-                    self.update_image()
+                    self._remove_dragged_annotation(self._dragged_box_index)
+                else:
+                    self._push_move(self._dragged_box_index)
                 self._dragged_box_index = None
                 self._dragged_box_corner = None
             elif not self._bounding_box_start or not self._bounding_box_end:  # There is no dragging or drawing
@@ -384,7 +797,6 @@ class ImageAnnotator(QtWidgets.QMainWindow):
                 self._bounding_box_start = None
                 self._bounding_box_end = None
                 self.update_image()
-                self._is_saved = True
                 return
 
             class_idx = self._class_names.index(class_name)
@@ -397,110 +809,385 @@ class ImageAnnotator(QtWidgets.QMainWindow):
             normalized_bottom_right = QtCore.QPointF(bottom_right.x() / self._m_pixmap.width(),
                                                      bottom_right.y() / self._m_pixmap.height())
 
-            # Add the bounding box information to the QListWidget
-            item = QtWidgets.QListWidgetItem(
-                f"{class_idx}, "
-                f"{normalized_top_left.x():.4f}, "
-                f"{normalized_top_left.y():.4f}, "
-                f"{normalized_bottom_right.x():.4f}, "
-                f"{normalized_bottom_right.y():.4f}"
-            )
-            item.setFlags(item.flags() | QtCore.Qt.ItemFlag.ItemIsEditable)
-            self._coordinates_list.addItem(item)
+            self._add_annotation(BoundingBox(class_idx,
+                                             normalized_top_left.x(), normalized_top_left.y(),
+                                             normalized_bottom_right.x(), normalized_bottom_right.y()))
+            self._undo_stack.push(AddCommand(len(self._annotations) - 1, self._annotations[-1]))
+            self._mark_dirty()
             self._bounding_box_start = None
             self._bounding_box_end = None
             self.update_image()
 
-    def update_image(self):
-        # Clear the old image item from the scene
-        self._scene.removeItem(self._image_item)
-        self._scene.clear()
-
-        # Create a new pixmap with the updated key points or bounding boxes
-        pixmap = self._m_pixmap.copy()
-        qp = QtGui.QPainter(pixmap)
-        point_size = self._point_size_spinbox.value()
-
-        # Draw
-        for i in range(self._coordinates_list.count()):
-            item_text = self._coordinates_list.item(i).text().split(",")
-            class_idx = int(item_text[0])
-            color = self._class_colors[class_idx]
-            color = QtGui.QColor(color.strip())
-
-            if len(item_text) == 5:  # Bounding box
-                qp.setPen(QtGui.QPen(color, 2, QtCore.Qt.SolidLine))
-                normalized_top_left = QtCore.QPointF(float(item_text[1]), float(item_text[2]))
-                normalized_bottom_right = QtCore.QPointF(float(item_text[3]), float(item_text[4]))
-                top_left = QtCore.QPoint(int(normalized_top_left.x() * pixmap.width()),
-                                         int(normalized_top_left.y() * pixmap.height()))
-                bottom_right = QtCore.QPoint(int(normalized_bottom_right.x() * pixmap.width()),
-                                             int(normalized_bottom_right.y() * pixmap.height()))
-                qp.drawRect(QtCore.QRect(top_left, bottom_right).normalized())
-
-                # Add special points on the corners of bounding box
-                qp.setPen(QtGui.QPen(QtCore.Qt.green, 10))  # you can adjust the pen size as per your requirement
-                qp.drawPoint(top_left)  # top-left corner
-                qp.drawPoint(bottom_right.x(), top_left.y())  # top-right corner
-                qp.drawPoint(bottom_right)  # bottom-right corner
-                qp.drawPoint(top_left.x(), bottom_right.y())  # bottom-left corner
-
-            elif len(item_text) == 3:  # Keypoint
-                qp.setPen(QtGui.QPen(color, point_size))
-                normalized_x, normalized_y = float(item_text[1]), float(item_text[2])
-                x, y = int(normalized_x * pixmap.width()), int(normalized_y * pixmap.height())
-                qp.drawPoint(QtCore.QPoint(x, y))
+        elif self._mode == "polygons":
+            if self._dragged_vertex_index is None:
+                return
+            row, polygon = self._dragged_vertex_index, self._annotations[self._dragged_vertex_index]
+            self._dragged_vertex_index = None
+            scene_pos = self._graphics_view.mapToScene(event.pos())
+            if 0 <= scene_pos.x() < self._m_pixmap.width() and 0 <= scene_pos.y() < self._m_pixmap.height():
+                self._push_move(row)
+                return
+            # A vertex dropped outside the image is removed, the whole polygon once it has less than three
+            if len(polygon.points) <= 3:
+                self._remove_dragged_annotation(row)
+                return
+            points = list(polygon.points)
+            del points[self._dragged_vertex]
+            self._unindex_annotation(row)
+            polygon.points = tuple(points)
+            self._refresh_annotation_item(row)
+            self._push_move(row)
+            self.update_image()
 
+    def _finish_polygon(self):
+        class_name, ok = QtWidgets.QInputDialog.getItem(self, "Select class dialog",
+                                                        "List of classes", self._class_names, 0, False)
+        points = [(point.x() / self._m_pixmap.width(), point.y() / self._m_pixmap.height())
+                  for point in self._polygon_points]
+        self._polygon_points = []
+        if ok:
+            self._add_annotation(Polygon(self._class_names.index(class_name), points))
+            self._undo_stack.push(AddCommand(len(self._annotations) - 1, self._annotations[-1]))
+            self._mark_dirty()
+        self.update_image()
+
+    def _native_position(self, x, y):
+        # Masks are painted at the native resolution of the image, not the one of the downscaled pixmap
+        return x * self._native_size[0] / self._m_pixmap.width(), y * self._native_size[1] / self._m_pixmap.height()
+
+    def _mask_at(self, x, y):
+        # The topmost mask with a set pixel under the cursor
+        for row in range(len(self._annotations) - 1, -1, -1):
+            if isinstance(self._annotations[row], Mask) and self._annotation_items[row].covers(x, y):
+                return row
+        return None
+
+    def _press_mask(self, x, y, erase):
+        row = self._mask_at(x, y)
+        new = row is None
+        if new:
+            if erase:
+                return
+            # Clicking outside every mask starts a new one, strokes that start on it extend it afterwards
+            class_name, ok = QtWidgets.QInputDialog.getItem(self, "Select class dialog",
+                                                            "List of classes", self._class_names, 0, False)
+            if not ok:
+                return
+            import numpy as np
+            width, height = self._native_size
+            self._add_annotation(Mask(self._class_names.index(class_name), width, height, [width * height]))
+            row = len(self._annotations) - 1
+            self._annotation_items[row].begin_painting(np.zeros((height, width), dtype=bool))
+        else:
+            self._annotation_items[row].begin_painting()
+        self._drag_start_coordinates = self._annotations[row].coordinates()
+        self._painted_mask_index = row
+        self._paint_value = not erase
+        self._last_paint_position = self._native_position(x, y)
+        self._paint_to(self._last_paint_position)
+        self._flush_mouse_move()
+        if new:
+            # The class dialog took the mouse, the release of this click never arrives
+            self._finish_painting(new=True)
+
+    def _paint_to(self, position):
+        from masks import paint_stroke
+        radius = self._brush_size_spinbox.value() / 2 * self._native_size[0] / self._m_pixmap.width()
+        rect = paint_stroke(self._annotation_items[self._painted_mask_index].bitmap, self._last_paint_position,
+                            position, radius, self._paint_value)
+        self._last_paint_position = position
+        if rect is not None and self._painted_rect is not None:
+            rect = (min(rect[0], self._painted_rect[0]), min(rect[1], self._painted_rect[1]),
+                    max(rect[2], self._painted_rect[2]), max(rect[3], self._painted_rect[3]))
+        self._painted_rect = rect or self._painted_rect
+
+    def _finish_painting(self, new=False):
+        from masks import encode_mask
+        row, item = self._painted_mask_index, self._annotation_items[self._painted_mask_index]
+        self._painted_mask_index = None
+        if not item.bitmap.any():
+            # Erased completely, undoing brings it back as it was before the stroke
+            self._remove_dragged_annotation(row)
+            return
+        self._annotations[row].set_coordinates(encode_mask(item.bitmap))
+        item.end_painting()
+        self._refresh_annotation_item(row)
+        if new:
+            self._undo_stack.push(AddCommand(row, self._annotations[row]))
+            self._drag_start_coordinates = None
+        else:
+            self._push_move(row)
+        self._mark_dirty()
+
+    def _push_move(self, index):
+        # A whole drag is one undo step, however many move events it took
+        coordinates = self._annotations[index].coordinates()
+        if coordinates != self._drag_start_coordinates:
+            self._undo_stack.push(MoveCommand(index, self._drag_start_coordinates, coordinates))
+        self._drag_start_coordinates = None
+
+    def _remove_dragged_annotation(self, index):
+        # Undoing the removal brings the annotation back where the drag started
+        annotation = self._annotations[index]
+        annotation.set_coordinates(self._drag_start_coordinates)
+        self._drag_start_coordinates = None
+        self._undo_stack.push(DeleteCommand(index, annotation))
+        self._remove_annotation(index)
+        self._mark_dirty()
+        self.update_image()
+
+    def undo(self):
+        if self._undo_stack.undo(self):
+            self.update_image()
+
+    def redo(self):
+        if self._undo_stack.redo(self):
+            self.update_image()
+
+    # Editing operations the undo commands are applied through
+    def insert_annotation(self, index, annotation):
+        self._insert_annotation(index, annotation)
+        self._mark_dirty()
+
+    def remove_annotation(self, index):
+        self._remove_annotation(index)
+        self._mark_dirty()
+
+    def set_coordinates(self, index, coordinates):
+        # A polygon may get back a different number of vertices
+        self._unindex_annotation(index)
+        self._annotations[index].set_coordinates(coordinates)
+        self._refresh_annotation_item(index)
+        self._mark_dirty()
+
+    def set_class(self, index, class_idx):
+        self._annotations[index].class_idx = class_idx
+        self._refresh_annotation_item(index)
+        self._mark_dirty()
+
+    def replace_annotation(self, index, annotation):
+        self._replace_annotation(index, annotation)
+        self._mark_dirty()
+
+    def _point_size_changed(self, point_size):
+        self._class_styles.set_point_size(point_size)
+        self._restyle_annotations()
+
+    def update_image(self):
+        # Annotation items are styled when created and refreshed one at a time when edited, only the shapes
+        # being drawn are left to update here
+        with recorder.stage("redraw"):
+            self._update_rubber_band()
+
+    def _restyle_annotations(self):
+        # After a class color or the point size changed, every item may need another pen
+        with recorder.stage("redraw"):
+            for annotation, item in zip(self._annotations, self._annotation_items):
+                self._style_annotation_item(annotation, item)
+
+    def _style_annotation_item(self, annotation, item):
+        # Pens and brushes are shared per class, handing in the same one again costs nothing
+        item.set_pen(self._annotation_pen(annotation))
+        if isinstance(annotation, (Polygon, Mask)):
+            item.set_brush(self._class_styles.brush(annotation.class_idx))
+
+    def _update_rubber_band(self):
         # Draw the bounding box being created
         if self._mode == "bounding_boxes" and self._bounding_box_start and self._bounding_box_end:
-            qp.setPen(QtGui.QPen(QtGui.QColor(QtCore.Qt.green), 1, QtCore.Qt.SolidLine))
-            bounding_box_rect = QtCore.QRect(self._bounding_box_start, self._bounding_box_end)
-            qp.drawRect(bounding_box_rect.normalized())
-        qp.end()
+            self._rubber_band_item.setRect(QtCore.QRectF(self._bounding_box_start, self._bounding_box_end).normalized())
+            self._rubber_band_item.show()
+        else:
+            self._rubber_band_item.hide()
+        if self._mode == "polygons" and self._polygon_points:
+            path = QtGui.QPainterPath()
+            path.addPolygon(QtGui.QPolygonF(self._polygon_points))
+            self._polygon_draft_item.setPath(path)
+            self._polygon_draft_item.show()
+        else:
+            self._polygon_draft_item.hide()
 
-        # Create a new image item with the updated pixmap and add it to the scene
-        self._image_item = QtWidgets.QGraphicsPixmapItem(pixmap)
-        self._scene.addItem(self._image_item)
-        self._scene.update()
+    def _annotation_pen(self, annotation):
+        # Cached per class, restyling allocates nothing per annotation
+        if isinstance(annotation, (BoundingBox, Polygon, Mask)):
+            return self._class_styles.box_pen(annotation.class_idx)
+        return self._class_styles.keypoint_pen(annotation.class_idx)
 
-        # There are changes waiting
-        self._is_saved = False
+    def _load_pixmap(self):
+        image_path = os.path.join(self._current_directory, self._image_filenames[self._current_image_index])
+        with recorder.stage("load_image"):
+            # The pixmap shares the pixels of the decoded image rather than copying them, so the image is kept
+            # for as long as the pixmap is shown
+            self._img = self._prefetcher.get(image_path)
+        with recorder.stage("upload"):
+            self._m_pixmap = QtGui.QPixmap.fromImage(self._img)
+            self._image_item.setPixmap(self._m_pixmap)
+        self._load_tiles(image_path)
+        self._prefetch_neighbours()
+
+    def _load_tiles(self, image_path):
+        self._tile_loader.cancel_pending()
+        if self._tiled_item is not None:
+            self._scene.removeItem(self._tiled_item)
+            self._tiled_item = None
+        source = TileSource(image_path)
+        self._native_size = source.size
+        native_width = source.size[0]
+        if native_width > self._m_pixmap.width():
+            self._tiled_item = TiledImageItem(source, self._tile_loader, self._m_pixmap.width(),
+                                              self._m_pixmap.height())
+            self._tiled_item.setZValue(-1)
+            self._scene.addItem(self._tiled_item)
+        # Allow zooming in until one native pixel covers a few screen pixels
+        self._max_zoom = max(10.0, 4 * native_width / self._m_pixmap.width())
+
+    def _tile_ready(self, source, key):
+        if self._tiled_item is not None and self._tiled_item.source is source:
+            self._tiled_item.tile_loaded(key)
 
     def load_image(self):
-        image_path = os.path.join(self._current_directory, self._image_filenames[self._current_image_index])
-        image = PIL.Image.open(image_path)
-        resizer = Resizer(self._target_height, self._target_width)
-        image = resizer.resize(image)
-        self._img = PIL.ImageQt.ImageQt(image)
-        self._m_pixmap = QtGui.QPixmap.fromImage(self._img)
-        self._image_item = QtWidgets.QGraphicsPixmapItem(self._m_pixmap)
+        self._load_pixmap()
         self._scene.setSceneRect(0, 0, self._m_pixmap.width(), self._m_pixmap.height())
         self._graphics_view.fitInView(self._scene.sceneRect(), Qt.KeepAspectRatio)
-        txt_file = os.path.join(self._current_directory,
-                                self._image_filenames[self._current_image_index].split(".")[0] + ".txt")
-        if os.path.exists(txt_file):
-            with open(txt_file, "r") as file:
-                for line in file:
-                    line_elements = line.strip().split(",")
-                    class_idx = int(line_elements[0])
-                    if len(line_elements) == 3:  # Keypoint
-                        normalized_x, normalized_y = line_elements[1], line_elements[2]
-                        item = QtWidgets.QListWidgetItem(f"{class_idx}, {normalized_x}, {normalized_y}")
-                    elif len(line_elements) == 5:  # Bounding box
-                        normalized_top_left_x, normalized_top_left_y = line_elements[1], line_elements[2]
-                        normalized_bottom_right_x, normalized_bottom_right_y = line_elements[3], line_elements[4]
-                        item = QtWidgets.QListWidgetItem(
-                            f"{class_idx}, "
-                            f"{normalized_top_left_x}, "
-                            f"{normalized_top_left_y}, "
-                            f"{normalized_bottom_right_x}, "
-                            f"{normalized_bottom_right_y}"
-                        )
-                    item.setFlags(item.flags() | QtCore.Qt.ItemFlag.ItemIsEditable)
-                    self._coordinates_list.addItem(item)
+        for annotation in self._annotation_store.load(self._image_filenames[self._current_image_index]):
+            self._add_annotation(annotation)
         self.update_image()
         self.update()
         self._is_saved = True
+        if not self._work_queue_mode:
+            # Where "Reopen last directory" continues on the next start
+            self._settings.setValue("last_image", self._image_filenames[self._current_image_index])
+        # In a work queue the next batch is leased while the last images of this one are still open,
+        # so the prefetcher can decode it ahead
+        elif self._current_image_index >= len(self._image_filenames) - 1 - self._prefetch_count:
+            self._lease_images()
+
+    def _prefetch_neighbours(self):
+        first = max(self._current_image_index - self._prefetch_count, 0)
+        last = min(self._current_image_index + self._prefetch_count, len(self._image_filenames) - 1)
+        # Nearest images first, the next one before the previous one
+        rows = sorted(range(first, last + 1),
+                      key=lambda row: (abs(row - self._current_image_index), row < self._current_image_index))
+        self._prefetcher.prefetch([os.path.join(self._current_directory, self._image_filenames[row])
+                                   for row in rows if row != self._current_image_index])
+
+    def _add_annotation(self, annotation):
+        self._insert_annotation(len(self._annotations), annotation)
+
+    def _insert_annotation(self, index, annotation):
+        self._annotations.insert(index, annotation)
+        item = QtWidgets.QListWidgetItem(annotation.to_text())
+        item.setFlags(item.flags() | QtCore.Qt.ItemFlag.ItemIsEditable)
+        self._coordinates_list.insertItem(index, item)
+        graphics_item = create_annotation_item(annotation, self._m_pixmap.width(), self._m_pixmap.height(),
+                                               self._annotation_pen(annotation),
+                                               self._class_styles.brush(annotation.class_idx))
+        self._annotation_items.insert(index, graphics_item)
+        self._scene.addItem(graphics_item)
+        if index == len(self._annotations) - 1:
+            self._index_annotation(index)
+        else:
+            self._reindex_annotations()
+
+    def _remove_annotation(self, index):
+        del self._annotations[index]
+        item_to_delete = self._coordinates_list.takeItem(index)
+        del item_to_delete
+        self._scene.removeItem(self._annotation_items.pop(index))
+        self._reindex_annotations()
+
+    def _reindex_annotations(self):
+        # Rows after an inserted or removed one shift, so their keys have to be rebuilt
+        self._spatial_index.clear()
+        for row in range(len(self._annotations)):
+            self._index_annotation(row)
+
+    def _clear_annotations(self):
+        self._annotations.clear()
+        self._coordinates_list.clear()
+        for graphics_item in self._annotation_items:
+            self._scene.removeItem(graphics_item)
+        self._annotation_items.clear()
+        self._spatial_index.clear()
+        self._undo_stack.clear()
+        self._move_timer.stop()
+        self._moved_annotation_index = None
+        self._polygon_points = []
+        self._dragged_vertex_index = None
+        self._painted_mask_index = None
+        self._painted_rect = None
+        self._update_rubber_band()
+
+    def _refresh_annotation_item(self, index):
+        # Programmatic text updates must not be mistaken for user edits
+        self._coordinates_list.blockSignals(True)
+        self._coordinates_list.item(index).setText(self._annotations[index].to_text())
+        self._coordinates_list.blockSignals(False)
+        # Only the graphics item and index entries of this annotation are updated, a new class needs its pen
+        self._style_annotation_item(self._annotations[index], self._annotation_items[index])
+        self._annotation_items[index].sync()
+        self._index_annotation(index)
+
+    def _index_annotation(self, row):
+        annotation = self._annotations[row]
+        width, height = self._m_pixmap.width(), self._m_pixmap.height()
+        if isinstance(annotation, Keypoint):
+            self._spatial_index.insert((row, 0, "point"), int(annotation.x * width), int(annotation.y * height))
+        elif isinstance(annotation, BoundingBox):
+            for order, (corner, corner_x, corner_y) in enumerate(annotation.corners()):
+                self._spatial_index.insert((row, order, corner), int(corner_x * width), int(corner_y * height))
+        elif isinstance(annotation, Polygon):
+            points = annotation.points
+            for order, (vertex_x, vertex_y) in enumerate(points):
+                next_x, next_y = points[(order + 1) % len(points)]
+                self._spatial_index.insert((row, order, "vertex"), int(vertex_x * width), int(vertex_y * height))
+                self._spatial_index.insert((row, order, "midpoint"), int((vertex_x + next_x) / 2 * width),
+                                           int((vertex_y + next_y) / 2 * height))
+
+    def _unindex_annotation(self, row):
+        annotation = self._annotations[row]
+        if isinstance(annotation, Keypoint):
+            self._spatial_index.remove((row, 0, "point"))
+        elif isinstance(annotation, BoundingBox):
+            for order, (corner, _, _) in enumerate(annotation.corners()):
+                self._spatial_index.remove((row, order, corner))
+        elif isinstance(annotation, Polygon):
+            for order in range(len(annotation.points)):
+                self._spatial_index.remove((row, order, "vertex"))
+                self._spatial_index.remove((row, order, "midpoint"))
+
+    def _annotation_item_edited(self, item):
+        # The user edited a row of the list by hand, parse it once and store it in the model
+        index = self._coordinates_list.row(item)
+        before = self._annotations[index]
+        try:
+            annotation = parse_annotation(item.text())
+        except ValueError:
+            annotation = before
+        # Rows show six decimals, so unchanged coordinates are compared at that precision
+        if type(annotation) is type(before) and \
+                [round(value, 6) for value in annotation.coordinates()] == \
+                [round(value, 6) for value in before.coordinates()]:
+            if annotation.class_idx != before.class_idx:
+                self._undo_stack.push(ReclassCommand(index, before.class_idx, annotation.class_idx))
+                self.set_class(index, annotation.class_idx)
+            else:
+                self._refresh_annotation_item(index)
+        else:
+            self._undo_stack.push(ReplaceCommand(index, before, annotation))
+            self.replace_annotation(index, annotation)
+        self.update_image()
+
+    def _replace_annotation(self, index, annotation):
+        # The row may have changed to another kind of annotation, drop its old index entries
+        self._unindex_annotation(index)
+        self._annotations[index] = annotation
+        self._scene.removeItem(self._annotation_items[index])
+        self._annotation_items[index] = create_annotation_item(annotation, self._m_pixmap.width(),
+                                                               self._m_pixmap.height(),
+                                                               self._annotation_pen(annotation),
+                                                               self._class_styles.brush(annotation.class_idx))
+        self._scene.addItem(self._annotation_items[index])
+        self._refresh_annotation_item(index)
 
     def zoom(self, event):
         zoom_in_factor = 1.25
@@ -520,7 +1207,7 @@ class ImageAnnotator(QtWidgets.QMainWindow):
         new_scale = current_scale * zoom_factor
 
         # Limit the scale factor to a reasonable range between "min_scale" and "max_scale"
-        new_scale = max(min(new_scale, 10.0), 0.1)
+        new_scale = max(min(new_scale, self._max_zoom), 0.1)
 
         # Set the new scale factor
         self._graphics_view.setTransform(QtGui.QTransform.fromScale(new_scale, new_scale))
@@ -528,6 +1215,36 @@ class ImageAnnotator(QtWidgets.QMainWindow):
     def wheelEvent(self, event):
         self.zoom(event)
 
+    def closeEvent(self, event):
+        if self._work_queue_mode:
+            # Handed in before anything is shut down, so the window can stay open if that fails. The current image
+            # counts as done like when it is left for another one
+            self._maybe_save()
+            self._autosaver.flush()
+            try:
+                self._annotation_store.submit()
+            except RuntimeError as error:
+                if self._ask_for_discarding(error) != QtWidgets.QMessageBox.Yes:
+                    self.statusBar().showMessage(str(error))
+                    event.ignore()
+                    return
+        if self._trace_path:
+            recorder.dump_chrome_trace(self._trace_path)
+        if self._profile_path:
+            recorder.stop_profiling(self._profile_path)
+        self._stop_scanning()
+        self._stop_pre_annotation()
+        self._thumbnail_loader.shutdown()
+        self._tile_loader.shutdown()
+        self._autosaver.close()
+        if self._annotation_store is not None:
+            try:
+                self._annotation_store.close()
+            except RuntimeError:
+                pass  # Only annotations the user chose to discard are left
+        self._prefetcher.shutdown()
+        super().closeEvent(event)
+
     def _ask_for_saving(self):
         msg = QtWidgets.QMessageBox()
         msg.setIcon(QtWidgets.QMessageBox.Question)
@@ -536,8 +1253,20 @@ class ImageAnnotator(QtWidgets.QMainWindow):
         retval = msg.exec_()
         return retval
 
+    def _ask_for_discarding(self, error):
+        msg = QtWidgets.QMessageBox()
+        msg.setIcon(QtWidgets.QMessageBox.Warning)
+        msg.setText("Some annotations could not be handed in to the work queue. Close and discard them?")
+        msg.setInformativeText(str(error))
+        msg.setStandardButtons(QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No)
+        retval = msg.exec_()
+        return retval
+
 
 if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
     window = ImageAnnotator()
+    window.show()
+    # Reopened once the empty window is on screen
+    QtCore.QTimer.singleShot(0, window.reopen_last_directory)
     sys.exit(app.exec_())
@@ -0,0 +1,60 @@
+import numpy as np
+from annotations import Mask
+
+
+def decode_mask(mask: Mask):
+    # A writable (height, width) bool array, the runs alternate between unset and set pixels
+    values = np.arange(len(mask.counts)) % 2 == 1
+    flat = np.repeat(values, mask.counts)
+    # Column-major, so the transpose of the (width, height) reshape is the image
+    return flat.reshape(mask.width, mask.height).T
+
+
+def encode_mask(bitmap):
+    # Inverse of decode_mask, run boundaries are found for all pixels at once instead of walking them
+    flat = bitmap.T.ravel()
+    if not len(flat):
+        return []
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], boundaries, [len(flat)])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.tolist()
+
+
+def mask_from_bitmap(class_idx, bitmap):
+    height, width = bitmap.shape
+    return Mask(class_idx, width, height, encode_mask(bitmap))
+
+
+def mask_area(mask: Mask):
+    return sum(mask.counts[1::2])
+
+
+def mask_bounds(bitmap):
+    # (left, top, right, bottom) of the set pixels with exclusive right and bottom, None for an empty mask
+    rows = np.flatnonzero(bitmap.any(axis=1))
+    if not len(rows):
+        return None
+    columns = np.flatnonzero(bitmap.any(axis=0))
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+def paint_stroke(bitmap, start, end, radius, value=True):
+    # Sets (or clears) every pixel whose center is within radius of the segment from start to end, a round brush
+    # dragged between two mouse positions. Returns the changed (left, top, right, bottom) or None
+    height, width = bitmap.shape
+    (x0, y0), (x1, y1) = start, end
+    left, right = max(int(np.floor(min(x0, x1) - radius)), 0), min(int(np.ceil(max(x0, x1) + radius)) + 1, width)
+    top, bottom = max(int(np.floor(min(y0, y1) - radius)), 0), min(int(np.ceil(max(y0, y1) + radius)) + 1, height)
+    if left >= right or top >= bottom:
+        return None
+    ys, xs = np.ogrid[top:bottom, left:right]
+    xs, ys = xs + 0.5 - x0, ys + 0.5 - y0
+    dx, dy = x1 - x0, y1 - y0
+    length_squared = dx * dx + dy * dy
+    # Position of the closest point on the segment, 0 at start and 1 at end
+    t = np.clip((xs * dx + ys * dy) / length_squared, 0, 1) if length_squared else 0
+    inside = (xs - t * dx) ** 2 + (ys - t * dy) ** 2 <= radius * radius
+    bitmap[top:bottom, left:right][inside] = value
+    return left, top, right, bottom
@@ -0,0 +1,237 @@
+"""Propose annotations for unannotated images with a local CPU model, for correction in the annotator.
+
+Usage: python pre_annotate.py DIRECTORY MODEL [--batch-size N] [--workers N] [--recursive] [--input-size N]
+                              [--score-threshold X]
+
+MODEL is either an .onnx file or a Python callable given as module:function. The callable receives a
+list of RGB PIL images and returns one list of Keypoint/BoundingBox objects, with normalized
+coordinates, per image.
+"""
+import argparse
+import hashlib
+import importlib
+import multiprocessing
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import PIL.Image
+from annotations import BoundingBox, parse_annotation
+from annotation_store import SQLiteAnnotationStore, open_store
+from dataset import scan_images, annotation_path
+from image_scaling import Resizer
+
+CACHE_NAME = ".pre_annotations.db"
+
+
+class OnnxDetector:
+    # Expects a (N, 3, S, S) float32 RGB input in [0, 1] and a first output of (N, K, 6) rows
+    # [left, top, right, bottom, score, class] in pixels of the S x S input
+    def __init__(self, path, input_size=640, score_threshold=0.5):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("ONNX models need onnxruntime, install it with: pip install onnxruntime")
+        self._session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self._input_name = self._session.get_inputs()[0].name
+        self._input_size = input_size
+        self._score_threshold = score_threshold
+
+    def __call__(self, images):
+        import numpy as np
+        # Stretching to a square keeps normalized coordinates valid without any letterbox bookkeeping
+        batch = np.stack([np.asarray(image.resize((self._input_size, self._input_size)), dtype=np.float32)
+                          for image in images])
+        batch = batch.transpose(0, 3, 1, 2) / 255.0
+        detections = self._session.run(None, {self._input_name: batch})[0]
+        results = []
+        for rows in detections:
+            rows = rows[rows[:, 4] >= self._score_threshold]
+            coordinates = np.clip(rows[:, :4] / self._input_size, 0.0, 1.0)
+            results.append([BoundingBox(int(class_idx), *map(float, box))
+                            for box, class_idx in zip(coordinates, rows[:, 5])])
+        return results
+
+
+def load_model(spec, input_size=640, score_threshold=0.5):
+    if spec.endswith(".onnx"):
+        return OnnxDetector(spec, input_size, score_threshold)
+    module_name, _, function_name = spec.partition(":")
+    if not function_name:
+        raise ValueError(f"Model must be an .onnx file or module:function, got {spec!r}")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def model_key(spec):
+    # Cached proposals are only reused for the same model, an .onnx file counts as changed when it is rewritten
+    if os.path.exists(spec):
+        stat = os.stat(spec)
+        return f"{os.path.abspath(spec)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return spec
+
+
+def _hash_image(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _hash_images(args):
+    directory, image_names = args
+    return [_hash_image(os.path.join(directory, name)) for name in image_names]
+
+
+class ProposalCache:
+    # Proposals keyed by image content and model, renamed or copied images are not run through the model again
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS proposals (hash TEXT, model TEXT, data TEXT NOT NULL, "
+                "PRIMARY KEY (hash, model)) WITHOUT ROWID"
+            )
+
+    def get_many(self, hashes, model):
+        found = {}
+        hashes = list(hashes)
+        # Stay below SQLite's limit on the number of parameters of one statement
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            query = (f"SELECT hash, data FROM proposals WHERE model = ? "
+                     f"AND hash IN ({', '.join('?' * len(chunk))})")
+            for image_hash, data in self._connection.execute(query, [model, *chunk]):
+                found[image_hash] = [parse_annotation(line) for line in data.splitlines() if line.strip()]
+        return found
+
+    def put_many(self, items, model):
+        rows = [(image_hash, model, "\n".join(annotation.to_text() for annotation in annotations))
+                for image_hash, annotations in items]
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO proposals (hash, model, data) VALUES (?, ?, ?)",
+                                         rows)
+
+    def close(self):
+        self._connection.close()
+
+
+_model = None
+
+
+def _load_worker_model(spec, input_size, score_threshold):
+    # Every worker process loads the model once and keeps it for all of its batches
+    global _model
+    _model = load_model(spec, input_size, score_threshold)
+
+
+def _predict_batch(args):
+    directory, image_names, input_size = args
+    resizer = Resizer(input_size, input_size)
+    images = []
+    for image_name in image_names:
+        with PIL.Image.open(os.path.join(directory, image_name)) as image:
+            images.append(resizer.resize(image).convert("RGB"))
+    return list(zip(image_names, _model(images)))
+
+
+def _is_annotated(store, directory, image_name, stored_names=None):
+    # stored_names is a snapshot of the project database for picking the pending images at once, without it the
+    # store itself is asked
+    if stored_names is not None:
+        return image_name in stored_names
+    if isinstance(store, SQLiteAnnotationStore):
+        return store.contains(image_name)
+    return os.path.exists(annotation_path(directory, image_name))
+
+
+def pre_annotate(directory, model_spec, image_names=None, store=None, recursive=False, batch_size=16,
+                 workers=None, input_size=640, score_threshold=0.5, progress=lambda done, total: None,
+                 is_cancelled=lambda: False):
+    # Returns the number of images that received proposals
+    if image_names is None:
+        image_names = sorted(scan_images(directory, recursive))
+    own_store = store is None
+    if own_store:
+        store = open_store(directory)
+    stored_names = set(store.image_names()) if isinstance(store, SQLiteAnnotationStore) else None
+    cache = ProposalCache(os.path.join(directory, CACHE_NAME))
+    model = model_key(model_spec)
+    workers = workers or os.cpu_count() or 1
+    written = 0
+
+    def save(image_name, annotations):
+        nonlocal written
+        # Checked again right before writing, the user may have annotated the image in the meantime
+        if annotations and not _is_annotated(store, directory, image_name):
+            store.save(image_name, annotations)
+            written += 1
+
+    try:
+        pending = [name for name in image_names if not _is_annotated(store, directory, name, stored_names)]
+        total = len(pending)
+        # Spawned rather than forked, the GUI runs this from a thread while Qt threads are running
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_load_worker_model,
+                                 initargs=(model_spec, input_size, score_threshold)) as executor:
+            # Hashing reads every file, so it is spread over the workers too. The chunks are kept small enough
+            # that cancelling does not wait for a large share of the directory to be read
+            chunksize = min(max(1, len(pending) // (workers * 4)), 64)
+            chunks = [(directory, pending[start:start + chunksize]) for start in range(0, len(pending), chunksize)]
+            hashes = {}
+            for (_, names), chunk_hashes in zip(chunks, executor.map(_hash_images, chunks)):
+                if is_cancelled():
+                    executor.shutdown(cancel_futures=True)
+                    return written
+                hashes.update(zip(names, chunk_hashes))
+            cached = cache.get_many(set(hashes.values()), model)
+            uncached = []
+            for image_name in pending:
+                if hashes[image_name] in cached:
+                    save(image_name, cached[hashes[image_name]])
+                else:
+                    uncached.append(image_name)
+            done = total - len(uncached)
+            progress(done, total)
+
+            batches = [(directory, uncached[start:start + batch_size], input_size)
+                       for start in range(0, len(uncached), batch_size)]
+            for results in executor.map(_predict_batch, batches):
+                if is_cancelled():
+                    executor.shutdown(cancel_futures=True)
+                    break
+                cache.put_many([(hashes[image_name], annotations) for image_name, annotations in results], model)
+                for image_name, annotations in results:
+                    save(image_name, annotations)
+                done += len(results)
+                progress(done, total)
+    finally:
+        cache.close()
+        if own_store:
+            store.close()
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write model proposals for every unannotated image.")
+    parser.add_argument("directory", help="directory with the images and classes.txt")
+    parser.add_argument("model", help="an .onnx file or a Python callable as module:function")
+    parser.add_argument("--batch-size", type=int, default=16, help="images per model call")
+    parser.add_argument("--workers", type=int, default=None, help="number of inference processes")
+    parser.add_argument("--recursive", action="store_true", help="include images in subdirectories")
+    parser.add_argument("--input-size", type=int, default=640, help="side of the square model input in pixels")
+    parser.add_argument("--score-threshold", type=float, default=0.5, help="minimum score of ONNX detections")
+    args = parser.parse_args(argv)
+
+    def progress(done, total):
+        print(f"\r{done}/{total} images", end="", file=sys.stderr)
+
+    written = pre_annotate(args.directory, args.model, recursive=args.recursive, batch_size=args.batch_size,
+                           workers=args.workers, input_size=args.input_size,
+                           score_threshold=args.score_threshold, progress=progress)
+    print(f"\nWrote proposals for {written} images")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,25 @@
+from PySide6 import QtCore
+from pre_annotate import pre_annotate
+
+
+class PreAnnotationThread(QtCore.QThread):
+    progress = QtCore.Signal(int, int)
+    done = QtCore.Signal(int)
+    failed = QtCore.Signal(str)
+
+    def __init__(self, directory, model_spec, image_names, store, parent=None):
+        super().__init__(parent)
+        self._directory = directory
+        self._model_spec = model_spec
+        self._image_names = image_names
+        self._store = store
+
+    def run(self):
+        # Inference itself runs in worker processes, this thread only feeds them and writes the proposals
+        try:
+            written = pre_annotate(self._directory, self._model_spec, self._image_names, self._store,
+                                   progress=self.progress.emit, is_cancelled=self.isInterruptionRequested)
+        except Exception as error:
+            self.failed.emit(f"Pre-annotation failed: {error}")
+            return
+        self.done.emit(written)
@@ -0,0 +1,45 @@
+class GridIndex:
+    # Uniform grid over pixel positions, so looking up what is under the cursor only visits a few cells
+    def __init__(self, cell_size=16):
+        self._cell_size = cell_size
+        self._cells = {}
+        self._key_cells = {}
+
+    def _cell(self, x, y):
+        return int(x // self._cell_size), int(y // self._cell_size)
+
+    def insert(self, key, x, y):
+        if key in self._key_cells:
+            self.remove(key)
+        cell = self._cell(x, y)
+        self._cells.setdefault(cell, {})[key] = (x, y)
+        self._key_cells[key] = cell
+
+    def remove(self, key):
+        cell = self._key_cells.pop(key, None)
+        if cell is None:
+            return
+        bucket = self._cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self._cells[cell]
+
+    def clear(self):
+        self._cells.clear()
+        self._key_cells.clear()
+
+    def query(self, x, y, threshold):
+        # Yield every key whose position is closer than threshold to (x, y) on both axes
+        min_cell_x, min_cell_y = self._cell(x - threshold, y - threshold)
+        max_cell_x, max_cell_y = self._cell(x + threshold, y + threshold)
+        for cell_x in range(min_cell_x, max_cell_x + 1):
+            for cell_y in range(min_cell_y, max_cell_y + 1):
+                bucket = self._cells.get((cell_x, cell_y))
+                if not bucket:
+                    continue
+                for key, (key_x, key_y) in bucket.items():
+                    if abs(key_x - x) < threshold and abs(key_y - y) < threshold:
+                        yield key
+
+    def __len__(self):
+        return len(self._key_cells)
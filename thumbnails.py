@@ -0,0 +1,31 @@
+import hashlib
+import os
+from dataset import cache_directory
+
+THUMBNAIL_SIZE = 96
+
+
+def thumbnail_directory():
+    # Kept between runs, so reopening a directory regenerates nothing
+    return os.path.join(cache_directory(), "thumbnails")
+
+
+def thumbnail_path(image_path, cache_directory):
+    # Keyed by path, modification time and size, an edited or replaced image gets a new thumbnail
+    stat = os.stat(image_path)
+    key = hashlib.blake2b(f"{os.path.abspath(image_path)}\0{stat.st_mtime_ns}\0{stat.st_size}".encode(),
+                          digest_size=16).hexdigest()
+    # Sharded so no single directory ends up with tens of thousands of files
+    return os.path.join(cache_directory, key[:2], key + ".jpg")
+
+
+def generate_thumbnail(image_path, output_path, size=THUMBNAIL_SIZE):
+    # Runs in a worker process, JPEGs are decoded straight at a reduced size
+    from image_scaling import Resizer, FAST_RESAMPLE, open_image
+    with open_image(image_path) as image:
+        thumbnail = Resizer(size, size, resample=FAST_RESAMPLE).resize(image).convert("RGB")
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    temporary_path = f"{output_path}.{os.getpid()}.tmp"
+    thumbnail.save(temporary_path, "JPEG", quality=85)
+    os.replace(temporary_path, output_path)
+    return output_path
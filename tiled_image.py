@@ -0,0 +1,145 @@
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PySide6 import QtCore, QtWidgets
+from image_cache import ImageCache, to_qimage
+
+
+class TileSource:
+    # Multi-resolution view of one image file, level 0 is the native resolution and every next level halves it
+    def __init__(self, path, max_levels_in_memory=2):
+        # Created when the first image is loaded, PIL is not needed before that
+        from image_scaling import open_image
+        self.path = path
+        with open_image(path) as image:
+            self.size = image.size
+        self._levels = OrderedDict()
+        self._max_levels_in_memory = max_levels_in_memory
+        self._lock = threading.Lock()
+
+    def level_size(self, level):
+        return math.ceil(self.size[0] / 2 ** level), math.ceil(self.size[1] / 2 ** level)
+
+    def _load_level(self, level):
+        from image_scaling import open_image
+        width, height = self.level_size(level)
+        image = open_image(self.path)
+        if image.format == "JPEG":
+            # JPEG can decode straight to 1/2, 1/4 or 1/8 of its size
+            image.draft(image.mode, (width, height))
+        factor = image.size[0] // width
+        if factor > 1:
+            image = image.reduce(factor)
+        if image.size != (width, height):
+            image = image.resize((width, height))
+        image.load()
+        return image
+
+    def level_image(self, level):
+        with self._lock:
+            image = self._levels.get(level)
+            if image is None:
+                image = self._load_level(level)
+                self._levels[level] = image
+                while len(self._levels) > self._max_levels_in_memory:
+                    self._levels.popitem(last=False)
+            self._levels.move_to_end(level)
+            return image
+
+    def tile(self, level, column, row, tile_size):
+        image = self.level_image(level)
+        left, top = column * tile_size, row * tile_size
+        return image.crop((left, top, min(left + tile_size, image.size[0]), min(top + tile_size, image.size[1])))
+
+
+class TileLoader(QtCore.QObject):
+    # Emitted from a worker thread, Qt delivers it on the GUI thread
+    tile_ready = QtCore.Signal(object, object)
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_workers=2, tile_size=512, parent=None):
+        super().__init__(parent)
+        self.tile_size = tile_size
+        self._cache = ImageCache(max_bytes)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tiles")
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, source: TileSource, key):
+        return self._cache.get((source.path, key))
+
+    def request(self, source: TileSource, key):
+        with self._lock:
+            if (source.path, key) in self._pending:
+                return
+            self._pending[(source.path, key)] = self._executor.submit(self._load, source, key)
+
+    def _load(self, source, key):
+        try:
+            tile = source.tile(*key, self.tile_size)
+            self._cache.put((source.path, key), to_qimage(tile))
+        finally:
+            with self._lock:
+                self._pending.pop((source.path, key), None)
+        self.tile_ready.emit(source, key)
+
+    def cancel_pending(self):
+        # Tiles of an image that is no longer shown are not worth decoding
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+
+    def shutdown(self):
+        self.cancel_pending()
+        self._executor.shutdown(wait=False)
+
+
+class TiledImageItem(QtWidgets.QGraphicsItem):
+    # Drawn over the downscaled pixmap, only when zoomed in further than the pixmap resolution
+    def __init__(self, source: TileSource, loader: TileLoader, display_width, display_height):
+        super().__init__()
+        self.source = source
+        self._loader = loader
+        self._display_width, self._display_height = display_width, display_height
+        # Without it option.exposedRect is always the whole item and every tile would be requested
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QtCore.QRectF(0, 0, self._display_width, self._display_height)
+
+    def _level_for(self, level_of_detail):
+        # Native pixels covered by one screen pixel decide which level is sharp enough
+        native_per_screen_pixel = self.source.size[0] / (self._display_width * level_of_detail)
+        return max(int(math.floor(math.log2(max(native_per_screen_pixel, 1)))), 0)
+
+    def paint(self, painter, option, widget=None):
+        level = self._level_for(option.levelOfDetailFromTransform(painter.worldTransform()))
+        level_width, level_height = self.source.level_size(level)
+        if level_width <= self._display_width:
+            return  # The pixmap below is already as sharp as this level
+        scale = level_width / self._display_width
+        tile_size = self._loader.tile_size
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        first_column, last_column = int(exposed.left() * scale) // tile_size, int(exposed.right() * scale) // tile_size
+        first_row, last_row = int(exposed.top() * scale) // tile_size, int(exposed.bottom() * scale) // tile_size
+        for column in range(first_column, min(last_column, (level_width - 1) // tile_size) + 1):
+            for row in range(first_row, min(last_row, (level_height - 1) // tile_size) + 1):
+                key = (level, column, row)
+                tile = self._loader.get(self.source, key)
+                if tile is None:
+                    # Until it arrives, the downscaled pixmap below shows through
+                    self._loader.request(self.source, key)
+                    continue
+                painter.drawImage(self._tile_rect(key, tile.width(), tile.height()), tile)
+
+    def _tile_rect(self, key, tile_width, tile_height):
+        level, column, row = key
+        scale = self.source.level_size(level)[0] / self._display_width
+        tile_size = self._loader.tile_size
+        return QtCore.QRectF(column * tile_size / scale, row * tile_size / scale,
+                             tile_width / scale, tile_height / scale)
+
+    def tile_loaded(self, key):
+        tile_size = self._loader.tile_size
+        self.update(self._tile_rect(key, tile_size, tile_size))
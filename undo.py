@@ -0,0 +1,111 @@
+from collections import deque
+
+
+# Every command stores only what changed and is applied through the editor's insert_annotation,
+# remove_annotation, set_coordinates, set_class and replace_annotation methods
+class AddCommand:
+    __slots__ = ("index", "annotation")
+
+    def __init__(self, index, annotation):
+        self.index = index
+        self.annotation = annotation
+
+    def undo(self, editor):
+        editor.remove_annotation(self.index)
+
+    def redo(self, editor):
+        editor.insert_annotation(self.index, self.annotation)
+
+
+class DeleteCommand:
+    __slots__ = ("index", "annotation")
+
+    def __init__(self, index, annotation):
+        self.index = index
+        self.annotation = annotation
+
+    def undo(self, editor):
+        editor.insert_annotation(self.index, self.annotation)
+
+    def redo(self, editor):
+        editor.remove_annotation(self.index)
+
+
+class MoveCommand:
+    __slots__ = ("index", "before", "after")
+
+    def __init__(self, index, before, after):
+        self.index = index
+        self.before = before
+        self.after = after
+
+    def undo(self, editor):
+        editor.set_coordinates(self.index, self.before)
+
+    def redo(self, editor):
+        editor.set_coordinates(self.index, self.after)
+
+
+class ReclassCommand:
+    __slots__ = ("index", "before", "after")
+
+    def __init__(self, index, before, after):
+        self.index = index
+        self.before = before
+        self.after = after
+
+    def undo(self, editor):
+        editor.set_class(self.index, self.before)
+
+    def redo(self, editor):
+        editor.set_class(self.index, self.after)
+
+
+class ReplaceCommand:
+    # A hand edit of a row may change everything, including keypoint to bounding box
+    __slots__ = ("index", "before", "after")
+
+    def __init__(self, index, before, after):
+        self.index = index
+        self.before = before
+        self.after = after
+
+    def undo(self, editor):
+        editor.replace_annotation(self.index, self.before)
+
+    def redo(self, editor):
+        editor.replace_annotation(self.index, self.after)
+
+
+class UndoStack:
+    # Commands are pushed after their change was already made, the oldest ones fall off past max_length
+    def __init__(self, max_length=1000):
+        self._undo = deque(maxlen=max_length)
+        self._redo = []
+
+    def push(self, command):
+        self._undo.append(command)
+        self._redo.clear()
+
+    def undo(self, editor):
+        if not self._undo:
+            return False
+        command = self._undo.pop()
+        command.undo(editor)
+        self._redo.append(command)
+        return True
+
+    def redo(self, editor):
+        if not self._redo:
+            return False
+        command = self._redo.pop()
+        command.redo(editor)
+        self._undo.append(command)
+        return True
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+
+    def __len__(self):
+        return len(self._undo)
@@ -0,0 +1,215 @@
+"""Check a whole annotated directory for bad labels and print dataset statistics.
+
+Usage: python validate.py DIRECTORY [--workers N] [--recursive] [--json report.json]
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import PIL.Image
+from annotations import Keypoint, BoundingBox, Polygon, Mask, parse_annotation
+from annotation_store import SQLiteAnnotationStore, open_store
+from dataset import scan_images, read_class_names, annotation_path
+
+
+def _read_lines(directory, image_name, text):
+    # The text stored in the project database, or else the .txt file of the image
+    if text is not None:
+        return text.splitlines()
+    path = annotation_path(directory, image_name)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as file:
+        return file.readlines()
+
+
+def _check_image(args):
+    directory, image_name, class_count, text = args
+    issues = []
+    keypoints, boxes = [], []
+    # Class ids only, for counting
+    polygons, masks = [], []
+    keypoint_lines, box_lines = [], []
+    try:
+        with PIL.Image.open(os.path.join(directory, image_name)) as image:
+            width, height = image.size
+    except OSError as error:
+        return (image_name, [f"cannot open image: {error}"], None, np.empty((0, 3)), np.empty((0, 5)),
+                np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    for line_number, line in enumerate(_read_lines(directory, image_name, text), start=1):
+        if not line.strip():
+            continue
+        try:
+            annotation = parse_annotation(line)
+        except ValueError as error:
+            issues.append(f"line {line_number}: malformed: {error}")
+            continue
+        if not 0 <= annotation.class_idx < class_count:
+            issues.append(f"line {line_number}: unknown class id {annotation.class_idx}")
+        if isinstance(annotation, Keypoint):
+            keypoints.append((annotation.class_idx, annotation.x, annotation.y))
+            keypoint_lines.append(line_number)
+        elif isinstance(annotation, BoundingBox):
+            boxes.append((annotation.class_idx, annotation.top_left_x, annotation.top_left_y,
+                          annotation.bottom_right_x, annotation.bottom_right_y))
+            box_lines.append(line_number)
+        elif isinstance(annotation, Polygon):
+            polygons.append(annotation.class_idx)
+            if any(not (0 <= value <= 1) for value in annotation.coordinates()):
+                issues.append(f"line {line_number}: polygon outside the image")
+        elif isinstance(annotation, Mask):
+            masks.append(annotation.class_idx)
+            if (annotation.width, annotation.height) != (width, height):
+                issues.append(f"line {line_number}: mask of {annotation.width}x{annotation.height} pixels "
+                              f"for an image of {width}x{height}")
+    keypoints = np.array(keypoints, dtype=np.float64).reshape(-1, 3)
+    boxes = np.array(boxes, dtype=np.float64).reshape(-1, 5)
+    # Range and orientation checks for all annotations of the image at once
+    for row in np.flatnonzero(((keypoints[:, 1:] < 0) | (keypoints[:, 1:] > 1)).any(axis=1)):
+        issues.append(f"line {keypoint_lines[row]}: keypoint outside the image")
+    for row in np.flatnonzero(((boxes[:, 1:] < 0) | (boxes[:, 1:] > 1)).any(axis=1)):
+        issues.append(f"line {box_lines[row]}: box outside the image")
+    for row in np.flatnonzero((boxes[:, 1] >= boxes[:, 3]) | (boxes[:, 2] >= boxes[:, 4])):
+        issues.append(f"line {box_lines[row]}: box inverted or empty")
+    return (image_name, issues, (width, height), keypoints, boxes,
+            np.array(polygons, dtype=np.int64), np.array(masks, dtype=np.int64))
+
+
+def _histogram(values, bins, value_range):
+    counts, edges = np.histogram(values, bins=bins, range=value_range)
+    return {"counts": counts.tolist(), "edges": edges.round(4).tolist()}
+
+
+def compute_statistics(results, class_names):
+    class_count = len(class_names)
+    keypoints = np.concatenate([keypoints for _, _, _, keypoints, _, _, _ in results] or [np.empty((0, 3))])
+    boxes = np.concatenate([boxes for _, _, _, _, boxes, _, _ in results] or [np.empty((0, 5))])
+    polygon_classes = np.concatenate([polygons for _, _, _, _, _, polygons, _ in results]
+                                     or [np.empty(0, dtype=np.int64)])
+    mask_classes = np.concatenate([masks for _, _, _, _, _, _, masks in results] or [np.empty(0, dtype=np.int64)])
+    # Pixel size of the image each box belongs to, for aspect ratios in pixels rather than normalized units
+    box_image_sizes = np.concatenate(
+        [np.tile(size, (len(boxes), 1)) for _, _, size, _, boxes, _, _ in results if size is not None]
+        or [np.empty((0, 2))])
+
+    valid_keypoint_classes = keypoints[:, 0].astype(np.int64)
+    valid_keypoint_classes = valid_keypoint_classes[(valid_keypoint_classes >= 0)
+                                                    & (valid_keypoint_classes < class_count)]
+    valid_box_classes = boxes[:, 0].astype(np.int64)
+    valid_box_classes = valid_box_classes[(valid_box_classes >= 0) & (valid_box_classes < class_count)]
+    keypoint_counts = np.bincount(valid_keypoint_classes, minlength=class_count)
+    box_counts = np.bincount(valid_box_classes, minlength=class_count)
+    polygon_counts = np.bincount(polygon_classes[(polygon_classes >= 0) & (polygon_classes < class_count)],
+                                 minlength=class_count)
+    mask_counts = np.bincount(mask_classes[(mask_classes >= 0) & (mask_classes < class_count)], minlength=class_count)
+
+    box_widths = np.abs(boxes[:, 3] - boxes[:, 1])
+    box_heights = np.abs(boxes[:, 4] - boxes[:, 2])
+    pixel_widths = box_widths * box_image_sizes[:, 0]
+    pixel_heights = box_heights * box_image_sizes[:, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_aspect = np.log2(pixel_widths / pixel_heights)
+    log_aspect = log_aspect[np.isfinite(log_aspect)]
+
+    keypoints_per_image = np.array([len(keypoints) for _, _, size, keypoints, _, _, _ in results if size is not None])
+    density, _, _ = np.histogram2d(keypoints[:, 2], keypoints[:, 1], bins=10, range=[[0, 1], [0, 1]])
+
+    return {
+        "images": len(results),
+        "keypoints": int(len(keypoints)),
+        "boxes": int(len(boxes)),
+        "polygons": int(len(polygon_classes)),
+        "masks": int(len(mask_classes)),
+        "per_class": {name: {"keypoints": int(keypoint_counts[i]), "boxes": int(box_counts[i]),
+                             "polygons": int(polygon_counts[i]), "masks": int(mask_counts[i])}
+                      for i, name in enumerate(class_names)},
+        "box_width": _histogram(box_widths, 20, (0, 1)),
+        "box_height": _histogram(box_heights, 20, (0, 1)),
+        "box_log2_aspect": _histogram(log_aspect, 20, (-5, 5)),
+        "keypoints_per_image": {
+            "mean": float(keypoints_per_image.mean()) if len(keypoints_per_image) else 0.0,
+            "median": float(np.median(keypoints_per_image)) if len(keypoints_per_image) else 0.0,
+            "max": int(keypoints_per_image.max()) if len(keypoints_per_image) else 0,
+        },
+        # Rows are top to bottom, columns left to right, tenths of the image each
+        "keypoint_density_10x10": density.astype(np.int64).tolist(),
+    }
+
+
+def validate(directory, recursive=False, workers=None):
+    class_names = read_class_names(directory)
+    image_names = sorted(scan_images(directory, recursive))
+    store = open_store(directory)
+    try:
+        # With a project database the annotations are read from it, in one query, instead of from .txt files
+        texts = store.texts() if isinstance(store, SQLiteAnnotationStore) else None
+    finally:
+        store.close()
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(image_names) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            _check_image,
+            [(directory, name, len(class_names), None if texts is None else texts.get(name, ""))
+             for name in image_names],
+            chunksize=chunksize))
+
+    if texts is not None:
+        known_names = set(image_names)
+        orphaned = sorted(name for name in texts if name not in known_names)
+    else:
+        expected_annotation_files = {annotation_path(directory, name) for name in image_names}
+        orphaned = sorted(
+            name for name in scan_images(directory, recursive, extensions=(".txt",))
+            if name != "classes.txt" and os.path.join(directory, name) not in expected_annotation_files
+        )
+    unannotated = [name for name, _, size, keypoints, boxes, polygons, masks in results
+                   if size is not None and not (len(keypoints) or len(boxes) or len(polygons) or len(masks))]
+    return {
+        "issues": {name: issues for name, issues, _, _, _, _, _ in results if issues},
+        "orphaned_annotation_files": orphaned,
+        "unannotated_images": unannotated,
+        "statistics": compute_statistics(results, class_names),
+    }
+
+
+def print_report(report):
+    for image_name, issues in report["issues"].items():
+        for issue in issues:
+            print(f"{image_name}: {issue}")
+    for name in report["orphaned_annotation_files"]:
+        print(f"{name}: no matching image")
+    statistics = report["statistics"]
+    print(f"\n{statistics['images']} images, {statistics['keypoints']} keypoints, {statistics['boxes']} boxes, "
+          f"{statistics['polygons']} polygons, {statistics['masks']} masks")
+    print(f"{len(report['issues'])} images with issues, {len(report['orphaned_annotation_files'])} annotations "
+          f"without an image, {len(report['unannotated_images'])} unannotated images")
+    print(f"\n{'class':<24}{'keypoints':>10}{'boxes':>10}{'polygons':>10}{'masks':>10}")
+    for name, counts in statistics["per_class"].items():
+        print(f"{name:<24}{counts['keypoints']:>10}{counts['boxes']:>10}{counts['polygons']:>10}{counts['masks']:>10}")
+    per_image = statistics["keypoints_per_image"]
+    print(f"\nKeypoints per image: mean {per_image['mean']:.1f}, median {per_image['median']:.1f}, "
+          f"max {per_image['max']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Validate annotations and compute dataset statistics.")
+    parser.add_argument("directory", help="directory with the images, their .txt files and classes.txt")
+    parser.add_argument("--workers", type=int, default=None, help="number of checking processes")
+    parser.add_argument("--recursive", action="store_true", help="include images in subdirectories")
+    parser.add_argument("--json", default=None, help="also write the full report, with histograms, to this file")
+    args = parser.parse_args(argv)
+
+    report = validate(args.directory, args.recursive, args.workers)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+    # Non-zero when there is something to fix, so it can gate a training pipeline
+    return 1 if report["issues"] or report["orphaned_annotation_files"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""Hand out the images of one directory to many labellers, in leased batches, over HTTP.
+
+Usage: python work_queue.py DIRECTORY [--host 127.0.0.1] [--port 8765] [--lease-seconds 600] [--recursive]
+                            [--include-annotated]
+
+Labellers join with the "Join work queue" action of the annotator. The images must be readable by every
+labeller at the path the server was started with, for example on a shared drive.
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from annotations import parse_annotation
+from annotation_store import SQLiteAnnotationStore, open_store
+from dataset import scan_images, annotation_path
+
+QUEUE_DATABASE_NAME = "work_queue.db"
+DEFAULT_PORT = 8765
+
+
+class WorkQueue:
+    # Every image is open, leased to one labeller until its lease expires, or done
+    def __init__(self, directory, lease_seconds=600, recursive=False, include_annotated=False):
+        self.directory = os.path.abspath(directory)
+        self._lease_seconds = lease_seconds
+        self._store = open_store(self.directory)
+        self._lock = threading.Lock()
+        # The queue state survives restarts of the server, handed in work is never handed out again
+        self._connection = sqlite3.connect(os.path.join(self.directory, QUEUE_DATABASE_NAME),
+                                           check_same_thread=False)
+        stored_names = set(self._store.image_names()) if isinstance(self._store, SQLiteAnnotationStore) else None
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS images (name TEXT PRIMARY KEY, state TEXT NOT NULL, lease TEXT, "
+                "worker TEXT, expires REAL) WITHOUT ROWID"
+            )
+            rows = []
+            for image_name in scan_images(self.directory, recursive):
+                annotated = (image_name in stored_names if stored_names is not None
+                             else os.path.exists(annotation_path(self.directory, image_name)))
+                rows.append((image_name, "done" if annotated and not include_annotated else "open"))
+            self._connection.executemany("INSERT OR IGNORE INTO images (name, state) VALUES (?, ?)", rows)
+
+    def _expire(self, now):
+        # Abandoned images go back to the pool, the lease id is kept so a late submit can still be accepted
+        self._connection.execute("UPDATE images SET state = 'open' WHERE state = 'leased' AND expires < ?", (now,))
+
+    def lease(self, worker, count):
+        now = time.time()
+        lease_id = uuid.uuid4().hex
+        with self._lock, self._connection:
+            self._expire(now)
+            names = [row[0] for row in self._connection.execute(
+                "SELECT name FROM images WHERE state = 'open' ORDER BY name LIMIT ?", (count,))]
+            self._connection.executemany(
+                "UPDATE images SET state = 'leased', lease = ?, worker = ?, expires = ? WHERE name = ?",
+                [(lease_id, worker, now + self._lease_seconds, name) for name in names])
+        annotations = {name: "\n".join(annotation.to_text() for annotation in self._store.load(name))
+                       for name in names}
+        return {"lease": lease_id, "expires": now + self._lease_seconds, "images": names,
+                "annotations": annotations}
+
+    def renew(self, lease_id):
+        now = time.time()
+        with self._lock, self._connection:
+            self._expire(now)
+            # Images of an expired lease that nobody else took yet are claimed back
+            renewed = self._connection.execute(
+                "UPDATE images SET state = 'leased', expires = ? WHERE lease = ? AND state IN ('leased', 'open')",
+                (now + self._lease_seconds, lease_id)).rowcount
+        return {"images": renewed, "expires": now + self._lease_seconds}
+
+    def submit(self, lease_id, annotations):
+        # annotations is {image name: annotation text}, only images still held by the lease are accepted
+        with self._lock:
+            held = {row[0] for row in self._connection.execute(
+                "SELECT name FROM images WHERE lease = ? AND state IN ('leased', 'open')", (lease_id,))}
+            accepted = [name for name in annotations if name in held]
+            items = [(name, [parse_annotation(line) for line in annotations[name].splitlines() if line.strip()])
+                     for name in accepted]
+            if isinstance(self._store, SQLiteAnnotationStore):
+                self._store.save_many(items)
+            else:
+                for name, image_annotations in items:
+                    self._store.save(name, image_annotations)
+            with self._connection:
+                self._connection.executemany("UPDATE images SET state = 'done', expires = NULL WHERE name = ?",
+                                             [(name,) for name in accepted])
+        return {"accepted": accepted, "rejected": [name for name in annotations if name not in held]}
+
+    def release(self, lease_id):
+        with self._lock, self._connection:
+            released = self._connection.execute(
+                "UPDATE images SET state = 'open', lease = NULL, worker = NULL, expires = NULL "
+                "WHERE lease = ? AND state IN ('leased', 'open')", (lease_id,)).rowcount
+        return {"images": released}
+
+    def status(self):
+        with self._lock, self._connection:
+            self._expire(time.time())
+            counts = dict(self._connection.execute("SELECT state, COUNT(*) FROM images GROUP BY state"))
+        return {"directory": self.directory, "open": counts.get("open", 0), "leased": counts.get("leased", 0),
+                "done": counts.get("done", 0)}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+            self._store.close()
+
+
+class WorkQueueHandler(BaseHTTPRequestHandler):
+    # JSON in, JSON out, the queue itself is self.server.queue
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._reply(200, self.server.queue.status())
+        else:
+            self._reply(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        queue = self.server.queue
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path == "/lease":
+                reply = queue.lease(str(request["worker"]), int(request.get("count", 20)))
+            elif self.path == "/renew":
+                reply = queue.renew(request["lease"])
+            elif self.path == "/submit":
+                reply = queue.submit(request["lease"], request["annotations"])
+            elif self.path == "/release":
+                reply = queue.release(request["lease"])
+            else:
+                self._reply(404, {"error": f"unknown path {self.path}"})
+                return
+        except (ValueError, KeyError, TypeError) as error:
+            self._reply(400, {"error": f"bad request: {error}"})
+            return
+        self._reply(200, reply)
+
+
+def create_server(queue: WorkQueue, host="127.0.0.1", port=DEFAULT_PORT):
+    server = ThreadingHTTPServer((host, port), WorkQueueHandler)
+    server.queue = queue
+    return server
+
+
+class WorkQueueStore:
+    # The annotation store of a labeller that joined a queue: images come in leases, saves are handed in in bulk
+    def __init__(self, url, lease_size=20, submit_every=10, timeout=30):
+        self._url = url.rstrip("/")
+        self._lease_size = lease_size
+        self._submit_every = submit_every
+        self._timeout = timeout
+        self._worker = f"{socket.gethostname()}-{os.getpid()}"
+        self._lock = threading.Lock()
+        # Image name -> lease id and the annotations the server had when the image was leased
+        self._leases = {}
+        self._annotations = {}
+        self._unsubmitted = {}
+        self.directory = self._request("/status")["directory"]
+        self._closed = threading.Event()
+        self._renew_interval = None
+        self._renewer = threading.Thread(target=self._renew_leases, name="lease renewal", daemon=True)
+
+    def _request(self, path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(self._url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self._timeout) as response:
+                return json.load(response)
+        except urllib.error.URLError as error:
+            raise RuntimeError(f"Work queue at {self._url} is not reachable: {error}") from error
+
+    def lease(self):
+        # The next batch of images, an empty list once every image is done or leased to someone else
+        reply = self._request("/lease", {"worker": self._worker, "count": self._lease_size})
+        with self._lock:
+            for name in reply["images"]:
+                self._leases[name] = reply["lease"]
+                self._annotations[name] = reply["annotations"].get(name, "")
+        if self._renew_interval is None:
+            # Renewed well before they run out, as long as the annotator is open
+            self._renew_interval = max((reply["expires"] - time.time()) / 3, 1)
+            self._renewer.start()
+        return reply["images"]
+
+    def load(self, image_name):
+        with self._lock:
+            text = self._annotations.get(image_name, "")
+        return [parse_annotation(line) for line in text.splitlines() if line.strip()]
+
+    def save(self, image_name, annotations):
+        text = "\n".join(annotation.to_text() for annotation in annotations)
+        with self._lock:
+            self._annotations[image_name] = text
+            self._unsubmitted[image_name] = text
+            ready = len(self._unsubmitted) >= self._submit_every
+        if ready:
+            self.submit()
+
+    def submit(self):
+        # One request per lease for everything saved since the last submit
+        with self._lock:
+            by_lease = {}
+            for name, text in self._unsubmitted.items():
+                by_lease.setdefault(self._leases[name], {})[name] = text
+            self._unsubmitted.clear()
+        rejected = []
+        for lease_id, annotations in by_lease.items():
+            try:
+                rejected += self._request("/submit", {"lease": lease_id, "annotations": annotations})["rejected"]
+            except RuntimeError:
+                with self._lock:
+                    # Kept for the next submit, unless the image was saved again in the meantime
+                    for name, text in annotations.items():
+                        self._unsubmitted.setdefault(name, text)
+                raise
+        if rejected:
+            raise RuntimeError(f"The work queue took back {len(rejected)} images after their lease expired: "
+                               + ", ".join(rejected))
+
+    def _renew_leases(self):
+        while not self._closed.wait(self._renew_interval):
+            with self._lock:
+                lease_ids = set(self._leases.values())
+            for lease_id in lease_ids:
+                try:
+                    self._request("/renew", {"lease": lease_id})
+                except RuntimeError:
+                    # Tried again at the next interval, the lease only runs out if the server stays unreachable
+                    pass
+
+    def close(self):
+        # Hand in what is left and give the images that were not reached back to the pool
+        self._closed.set()
+        try:
+            self.submit()
+        finally:
+            with self._lock:
+                lease_ids = set(self._leases.values())
+                self._leases.clear()
+            for lease_id in lease_ids:
+                try:
+                    self._request("/release", {"lease": lease_id})
+                except RuntimeError:
+                    # The lease runs out on its own
+                    pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the images of a directory to many labellers.")
+    parser.add_argument("directory", help="directory with the images and classes.txt")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on, 0.0.0.0 for the whole network")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("--lease-seconds", type=int, default=600,
+                        help="images of a labeller that stops renewing for this long go back to the pool")
+    parser.add_argument("--recursive", action="store_true", help="include images in subdirectories")
+    parser.add_argument("--include-annotated", action="store_true", help="also hand out already annotated images")
+    args = parser.parse_args(argv)
+
+    queue = WorkQueue(args.directory, args.lease_seconds, args.recursive, args.include_annotated)
+    server = create_server(queue, args.host, args.port)
+    status = queue.status()
+    print(f"Serving {status['open']} open images of {queue.directory} at http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queue.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())